@@ -0,0 +1,122 @@
+import queue
+import shlex
+import threading
+import subprocess
+
+# local imports
+from logger import logger
+
+
+class AdbShell:
+    """
+    A long-lived `adb shell` on one device that runs commands without spawning an adb process for each.
+    Commands are written to the shell's stdin, followed by an echo of a marker with their exit status, and
+    the output is read up to that marker. The shells are shared per udid within a process; refer to for_device.
+    """
+
+    SHELLS = {}  # udid -> AdbShell
+    SHELLS_LOCK = threading.Lock()
+
+    def __init__(self, udid=None, timeout=10):
+        self.udid = udid
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.process = None
+        self.lines = None  # stdout lines of process, read by a daemon thread
+        self.runs = 0
+
+    @classmethod
+    def for_device(cls, udid=None):
+        with cls.SHELLS_LOCK:
+            if udid not in cls.SHELLS:
+                cls.SHELLS[udid] = cls(udid)
+            return cls.SHELLS[udid]
+
+    @classmethod
+    def close_all(cls):
+        with cls.SHELLS_LOCK:
+            for shell in cls.SHELLS.values():
+                shell.close()
+            cls.SHELLS.clear()
+
+    @staticmethod
+    def quote_text(text):
+        """Quote text for `input text`, which reads %s as a space"""
+        return shlex.quote(text.replace(" ", "%s"))
+
+    def start(self):
+        serial = ["-s", self.udid] if self.udid else []
+        self.process = subprocess.Popen(
+            ["adb", *serial, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+        )
+        self.lines = queue.Queue()
+
+        def read(stdout, lines):
+            for line in stdout:
+                lines.put(line)
+            lines.put(None)  # the shell exited, e.g., when adbd restarts on `adb root`
+
+        threading.Thread(
+            target=read, args=(self.process.stdout, self.lines), daemon=True
+        ).start()
+
+    def close(self):
+        if self.process:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.kill()
+            self.process = None
+
+    def run(self, *commands):
+        """
+        Run commands one after another in the shell
+        :return: (exit status of the last command, output); (None, output) if the commands were not started,
+        e.g., when the shell could not be written to, and (-1, output) if the shell timed out or exited after
+        they were started, as they may have taken effect and must not be run again
+        """
+        with self.lock:
+            for attempt in range(2):  # restart the shell once if it has exited
+                if self.process is None or self.process.poll() is not None:
+                    try:
+                        self.start()
+                    except OSError as e:  # e.g., adb is not on the PATH
+                        return None, repr(e)
+                status, output = self.run_in_shell(commands)
+                if status is not None or attempt:
+                    return status, output
+                logger.info(f"adb shell of {self.udid} failed, restarting: {output}")
+                self.close()
+
+    def run_in_shell(self, commands):
+        self.runs += 1
+        marker = f"__transdroid_{self.runs}__"
+        # a subshell, so that an `exit` does not end the shell, and no stdin, which holds the next commands
+        script = f"({'; '.join(commands)}) < /dev/null\necho {marker}$?\n"
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        except OSError as e:  # the commands did not reach the shell
+            return None, repr(e)
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=self.timeout)
+            except queue.Empty:
+                self.close()
+                return -1, "".join(output) + f"(timed out after {self.timeout}s)"
+            if line is None:
+                self.close()
+                return -1, "".join(output) + "(adb shell exited)"
+            head, found, status = line.partition(marker)
+            if found:
+                output.append(head)
+                return int(status.strip() or 1), "".join(output)
+            output.append(line)
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import logging
+import argparse
+import traceback
+from statistics import mean
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# local imports
+from Explorer import Explorer
+from logger import logger
+from const import SNAPSHOT_FOLDER
+
+LOG_FOLDER = "logs"
+
+
+class BatchExplorer:
+    """
+    Transfer several tests of an app config in parallel, one Explorer per device. Each device is a
+    dict with the "udid" of an emulator/phone and the port of the Appium server that drives it.
+    A test runs on whichever device is free; its log and snapshot go to per-device folders.
+    """
+
+    def __init__(self, setting_path, devices, log_folder=LOG_FOLDER):
+        self.setting_path = setting_path
+        self.devices = devices
+        self.log_folder = log_folder
+
+    @staticmethod
+    def parse_device(spec, index):
+        """e.g., "emulator-5554:4723" -> {"udid": "emulator-5554", "appium_port": "4723", "system_port": 8200}"""
+        udid, _, appium_port = spec.rpartition(":")
+        return {
+            "udid": udid,
+            "appium_port": appium_port,
+            "system_port": 8200 + index,  # the UiAutomator2 server port on the host
+        }
+
+    def test_names(self):
+        with open(self.setting_path, "r") as f:
+            return list(json.load(f)["transfer_setting"])
+
+    def run(self, test_names=None):
+        """:return: {test name: result}; refer to BatchExplorer.transfer for the result"""
+        test_names = test_names or self.test_names()
+        results = {}
+        with Manager() as manager:
+            free_devices = manager.Queue()
+            for device in self.devices:
+                free_devices.put(device)
+            # as many workers as devices, so that a worker always finds a free device
+            with ProcessPoolExecutor(max_workers=len(self.devices)) as pool:
+                futures = {
+                    pool.submit(
+                        BatchExplorer.transfer,
+                        self.setting_path,
+                        test_name,
+                        free_devices,
+                        self.log_folder,
+                    ): test_name
+                    for test_name in test_names
+                }
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[futures[future]] = result
+                    logger.info(
+                        f"({len(results)}/{len(test_names)}) {futures[future]} on {result['device']}: "
+                        f"fitness {result['fitness']}, {result['seconds']}s"
+                        + (f", error: {result['error']}" if result["error"] else "")
+                    )
+        return {t: results[t] for t in test_names}
+
+    @staticmethod
+    def transfer(setting_path, test_name, free_devices, log_folder):
+        """
+        Transfer one test on a free device (run in a worker process)
+        :return: {"device", "fitness", "events", "waits", "round_trips", "seconds", "error"}
+        """
+        device = free_devices.get()
+        device_folder = os.path.join(log_folder, device["udid"].replace(":", "_"))
+        os.makedirs(device_folder, exist_ok=True)
+        handler = logging.FileHandler(
+            os.path.join(device_folder, test_name + ".log"), encoding="utf-8"
+        )
+        handler.setFormatter(logger.handlers[0].formatter)
+        logger.addHandler(handler)
+        start = time.time()
+        result = {"device": device["udid"], "fitness": None, "events": 0, "error": None}
+        explorer = None
+        try:
+            explorer = Explorer(
+                setting_path,
+                test_name,
+                device["appium_port"],
+                device["udid"],
+                device["system_port"],
+                os.path.join(SNAPSHOT_FOLDER, os.path.basename(device_folder)),
+            )
+            explorer.run()
+            explorer.save()
+            result["fitness"] = explorer.f
+            result["events"] = len(explorer.tgt_events)
+            result["waits"] = explorer.runner.wait_stats()
+            result["round_trips"] = explorer.runner.round_trip_stats()
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            result["error"] = repr(e)
+        finally:
+            if explorer:
+                try:
+                    if explorer.checkpoints:
+                        explorer.checkpoints.clear()
+                    if explorer.lookahead_pool:
+                        explorer.lookahead_pool.quit()
+                    explorer.runner.driver.quit()
+                except Exception:
+                    pass
+            logger.removeHandler(handler)
+            handler.close()
+            free_devices.put(device)
+        result["seconds"] = round(time.time() - start, 1)
+        return result
+
+    def save_summary(self, results):
+        fitness = [r["fitness"] for r in results.values() if r["fitness"] is not None]
+        summary = {
+            "config": self.setting_path,
+            "mean_fitness": mean(fitness) if fitness else None,
+            "failed": [t for t, r in results.items() if r["error"]],
+            "results": results,
+        }
+        os.makedirs(self.log_folder, exist_ok=True)
+        path = os.path.join(self.log_folder, "summary.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(
+            f"Mean fitness: {summary['mean_fitness']}, failed: {summary['failed']}. Saved to {path}"
+        )
+        return summary
+
+
+if __name__ == "__main__":
+    # e.g., python BatchExplorer.py config/owncloud/config.json --device emulator-5554:4723 --device emulator-5556:4725
+    parser = argparse.ArgumentParser(
+        description="Transfer the tests of an app config in parallel on several devices"
+    )
+    parser.add_argument("config", help="e.g., config/owncloud/config.json")
+    parser.add_argument(
+        "--device",
+        action="append",
+        required=True,
+        help="udid:appium_port of a device, repeated for each device",
+    )
+    parser.add_argument(
+        "--tests", nargs="*", help="test names to transfer (default: all of the config)"
+    )
+    parser.add_argument("--log-folder", default=LOG_FOLDER)
+    args = parser.parse_args()
+
+    batch = BatchExplorer(
+        args.config,
+        [BatchExplorer.parse_device(d, i) for i, d in enumerate(args.device)],
+        args.log_folder,
+    )
+    batch.save_summary(batch.run(args.tests))
@@ -1,6 +1,6 @@
 from flask import Flask, request, jsonify
-from flask_caching import Cache
 import logging
+import uuid
 
 from BenGPT import BenGPT
 
@@ -8,12 +8,14 @@ logging.basicConfig(filename="requests.log", level=logging.INFO)
 
 
 app = Flask(__name__)
-cache = Cache(app, config={"CACHE_TYPE": "simple"})
 sorter = BenGPT()
+# candidate widgets uploaded by get_candidates_batch clients, keyed by widget signature
+candidate_table = {}
+# identifies this run of the service, and so its candidate_table, to get_candidates_batch clients
+SESSION = uuid.uuid4().hex
 
 
 @app.route("/api/get_candidates", methods=["POST"])
-# @cache.cached(timeout=300000)  # Set an appropriate timeout in seconds
 def get_candidates():
     try:
         data = request.get_json()
@@ -57,5 +59,54 @@ def get_candidates():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/get_candidates_batch", methods=["POST"])
+def get_candidates_batch():
+    """
+    Rank many src_events in one call. Request:
+        {"table": {signature: candidate, ...},  # only the candidates not uploaded before
+         "requests": [{"src_event": {...}, "candidates": [signature, ...]}, ...]}
+    Response: {"results": [[{"signature": ..., "sim_score": ...}, ...], ...], "session": SESSION},
+    one list per request. Unknown signatures are answered with 409 and {"missing": [signature, ...],
+    "session": SESSION}; they are to be uploaded.
+    """
+    try:
+        data = request.get_json()
+
+        if "requests" not in data or not isinstance(data["requests"], list):
+            return jsonify({"error": "Missing 'requests' in the request"}), 400
+        candidate_table.update(data.get("table", {}))
+
+        requests_ = data["requests"]
+        missing = {
+            sig
+            for r in requests_
+            for sig in r.get("candidates", [])
+            if sig not in candidate_table
+        }
+        if missing:
+            return jsonify({"missing": sorted(missing), "session": SESSION}), 409
+        if any(not r.get("candidates") or "src_event" not in r for r in requests_):
+            return (
+                jsonify(
+                    {"error": "Each request needs a 'src_event' and some 'candidates'"}
+                ),
+                400,
+            )
+
+        logging.info("Batch Request: %s", requests_)
+        rankings = sorter.sort_candidates_batch(
+            [r["src_event"] for r in requests_],
+            [r["candidates"] for r in requests_],
+            candidate_table,
+        )
+        logging.info("Batch Result: %s", rankings)
+        logging.info("===============================")
+
+        return jsonify({"results": rankings, "session": SESSION})
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 if __name__ == "__main__":
     app.run(port=8000, debug=True)
@@ -0,0 +1,215 @@
+import json
+import time
+import asyncio
+import hashlib
+import uuid
+import logging
+import argparse
+from collections import deque
+from aiohttp import web
+
+from Provider import OpenAIProvider, StubProvider
+
+logging.basicConfig(filename="requests.log", level=logging.INFO)
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Abandoned(Overloaded):
+    """The request that identical ones joined was cancelled (e.g., its client disconnected); to be retried"""
+
+
+class RankingServer:
+    """
+    asyncio counterpart of API.py for many concurrent Explorer clients. At most max_concurrency
+    rankings run at once; identical in-flight requests share one ranking (single-flight), and
+    new rankings are refused with 503 once max_pending are in flight.
+    """
+
+    def __init__(self, provider, max_concurrency=8, max_pending=64, window=1000):
+        self.provider = provider
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.inflight = {}  # request key -> asyncio.Future of its result
+        self.latencies = deque(maxlen=window)  # seconds, of the latest requests
+        self.coalesced, self.rejected = 0, 0
+        # candidate widgets uploaded by get_candidates_batch clients, keyed by widget signature
+        self.candidate_table = {}
+        self.session = uuid.uuid4().hex  # refer to SESSION in API.py
+
+    def make_app(self):
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.add_routes(
+            [
+                web.post("/api/get_candidates", self.get_candidates),
+                web.post("/api/get_candidates_batch", self.get_candidates_batch),
+                web.get("/api/stats", self.get_stats),
+            ]
+        )
+        return app
+
+    @staticmethod
+    def request_key(route, payload):
+        canonical = json.dumps([route, payload], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def single_flight(self, key, rank):
+        """Run rank() unless an identical request is already running, then share its result"""
+        if key in self.inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self.inflight[key])
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded()
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        self.pending += 1
+        try:
+            async with self.slots:
+                result = await rank()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here in case no other request is waiting
+            raise
+        finally:
+            if (
+                not future.done()
+            ):  # cancelled; release the requests that joined this one
+                future.set_exception(Abandoned())
+                future.exception()
+            self.pending -= 1
+            del self.inflight[key]
+
+    @staticmethod
+    def percentile(values, q):
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+    def record(self, route, started):
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        stats = self.latency_stats()
+        logging.info(
+            "%s: %.1f ms (p50 %.1f ms, p95 %.1f ms)",
+            route,
+            latency * 1000,
+            stats["p50_ms"],
+            stats["p95_ms"],
+        )
+
+    def latency_stats(self):
+        return {
+            f"p{q}_ms": round(self.percentile(self.latencies, q) * 1000, 1)
+            if self.latencies
+            else 0
+            for q in [50, 95]
+        }
+
+    async def rank_or_error(self, route, key, rank, to_response):
+        started = time.perf_counter()
+        try:
+            return web.json_response(to_response(await self.single_flight(key, rank)))
+        except Overloaded:
+            return web.json_response(
+                {"error": "Too many pending requests"},
+                status=503,
+                headers={"Retry-After": "1"},
+            )
+        except Exception as e:
+            return web.json_response({"error": str(e)}, status=500)
+        finally:
+            self.record(route, started)
+
+    async def get_candidates(self, request):
+        data = await request.json()
+        if "candidates" not in data or "src_event" not in data:
+            return web.json_response(
+                {"error": "Missing 'candidates' or 'src_event' in the request"},
+                status=400,
+            )
+        candidates, src_event = data["candidates"], data["src_event"]
+        if not isinstance(candidates, list):
+            return web.json_response(
+                {"error": "Candidates must be an array of JSON objects"}, status=400
+            )
+        if len(candidates) < 1:
+            return web.json_response(
+                {"error": "There should be at least one candidates"}, status=400
+            )
+        return await self.rank_or_error(
+            "get_candidates",
+            self.request_key("get_candidates", data),
+            lambda: self.provider.sort_candidates(src_event, candidates),
+            lambda result: {"result": result},
+        )
+
+    async def get_candidates_batch(self, request):
+        """Same protocol as get_candidates_batch in API.py"""
+        data = await request.json()
+        if "requests" not in data or not isinstance(data["requests"], list):
+            return web.json_response(
+                {"error": "Missing 'requests' in the request"}, status=400
+            )
+        self.candidate_table.update(data.get("table", {}))
+        requests_ = data["requests"]
+        missing = {
+            sig
+            for r in requests_
+            for sig in r.get("candidates", [])
+            if sig not in self.candidate_table
+        }
+        if missing:
+            return web.json_response(
+                {"missing": sorted(missing), "session": self.session}, status=409
+            )
+        if any(not r.get("candidates") or "src_event" not in r for r in requests_):
+            return web.json_response(
+                {"error": "Each request needs a 'src_event' and some 'candidates'"},
+                status=400,
+            )
+        return await self.rank_or_error(
+            "get_candidates_batch",
+            self.request_key("get_candidates_batch", requests_),
+            lambda: self.provider.sort_candidates_batch(
+                [r["src_event"] for r in requests_],
+                [r["candidates"] for r in requests_],
+                self.candidate_table,
+            ),
+            lambda rankings: {"results": rankings, "session": self.session},
+        )
+
+    async def get_stats(self, request):
+        return web.json_response(
+            {
+                "requests": len(self.latencies),
+                "pending": self.pending,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                **self.latency_stats(),
+            }
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio BenGPT ranking server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--provider", choices=["openai", "stub"], default="openai")
+    parser.add_argument(
+        "--stub-delay", type=float, default=0.0, help="seconds per stub ranking"
+    )
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--max-pending", type=int, default=64)
+    args = parser.parse_args()
+
+    provider = (
+        StubProvider(args.stub_delay) if args.provider == "stub" else OpenAIProvider()
+    )
+    server = RankingServer(provider, args.max_concurrency, args.max_pending)
+    web.run_app(server.make_app(), port=args.port)
@@ -1,4 +1,6 @@
 import os
+import re
+import json
 from dotenv import load_dotenv
 import openai
 
@@ -10,24 +12,79 @@ openai.api_key = API_KEY
 
 
 class BenGPT:
+    # attributes that matter for similarity, with the short names used in prompts
+    SRC_FIELDS = {
+        "tag": "tag",
+        "id": "id",
+        "text": "text",
+        "prev_sibling_text": "prev",
+        "next_sibling_text": "next",
+    }
+    CANDIDATE_FIELDS = {
+        "class": "class",
+        "resource-id": "rid",
+        "text": "text",
+        "content-desc": "desc",
+        "parent_text": "parent",
+        "sibling_text": "sibling",
+    }
+    # one {"id": .., "score": ..} object of an answer that is not valid JSON (e.g., truncated); matched
+    # one by one so the complete objects still parse. Refer to parse_answer
+    SCORE_PATTERN = re.compile(r'"id"\s*:\s*(\d+)\s*,\s*"score"\s*:\s*(\d+(?:\.\d+)?)')
+    BATCH_SCORE_PATTERN = re.compile(
+        r'"event"\s*:\s*(\d+)\s*,\s*"id"\s*:\s*(\d+)\s*,\s*"score"\s*:\s*(\d+(?:\.\d+)?)'
+    )
+
+    @staticmethod
+    def compact(obj, fields):
+        """Only the non-empty fields, under their short names, as compact JSON"""
+        c = {}
+        for key, short in fields.items():
+            v = obj.get(key, "")
+            if isinstance(v, list):
+                v = " ".join(v)
+            if v:
+                c[short] = v.split(".")[-1] if key == "class" else v
+        return json.dumps(c, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def parse_answer(content, keys, pattern):
+        """
+        :param keys: the integer fields of an answer object before "score", e.g., ["event", "id"]
+        :return: [(*keys, score)] of the answer, a JSON array of objects; falls back to pattern if it is not JSON
+        """
+        start, end = content.find("["), content.rfind("]")  # e.g., in a ```json block
+        try:
+            items = json.loads(content[start : end + 1]) if start != -1 else None
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            return [
+                tuple(int(v) for v in m[:-1]) + (float(m[-1]),)
+                for m in pattern.findall(content)
+            ]
+        rows = []
+        for item in items:
+            try:
+                rows.append(tuple(int(item[k]) for k in keys) + (float(item["score"]),))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return rows
+
     @classmethod
     def sort_candidates(cls, src_event, candidates):
         """
-        The `sort_candidates` function uses OpenAI's Chat API to generate a response that contains the top 5
-        most similar events to `src_event` from the given `candidates` list, based on specific factors, and
-        returns the response as a JSON array.
-
-        :param cls: The parameter `cls` is a reference to the class itself. It is commonly used in class
-        methods to access class-level variables or methods. In this case, it seems that the
-        `sort_candidates` method is defined within a class, and `cls` is used as a placeholder for the class
-        reference
-        :param src_event: The source event that you want to find similar events to
-        :param candidates: The `candidates` parameter is a list of events that you want to sort and find the
-        top 5 most similar events to `src_event`. Each event in the `candidates` list should be a dictionary
-        with the following keys:
-        :return: The code is returning the content of the response received from the OpenAI ChatCompletion
-        API.
+        Ask the Chat API for the top 5 candidates most similar to src_event. Candidates are sent as
+        numbered compact records and the model answers with [{"id": number, "score": sim_score}].
+
+        :param src_event: the source event to find similar candidates for
+        :param candidates: the candidate widgets (dicts)
+        :return: a JSON array of the chosen candidates, each with a "sim_score", best first
         """
+        candidate_lines = "\n".join(
+            f"{i}: {cls.compact(c, cls.CANDIDATE_FIELDS)}"
+            for i, c in enumerate(candidates)
+        )
 
         response = openai.ChatCompletion.create(
             model="gpt-3.5-turbo",  # "gpt-4" or "gpt-3.5-turbo" --> 4k token or "gpt-3.5-turbo-16k" --> 16k token
@@ -35,25 +92,99 @@ class BenGPT:
                 {
                     "role": "user",
                     "content": f"""
-                        Compare the 'src_event' with the 'candidates' and find the top 5 candidates that are most similar in terms of their attributes. most important attributes is text
-                        After that you should compare id in src_event with resource-id in candidates
-                        Also content-desc in candidates have description of that candidate use it to find similarity between src_event and candidate
-                        
-                        don't change the candidates at all but add a sim_score a number between 0 and 1 based on how much the candidate is similar to the src_event
-                        try to find at least one element with sim_score more than 0
-                        don't include candidates with 0 sim_score in your response
+                        Compare the 'src_event' with the numbered 'candidates' and find the top 5 candidates that are most similar in terms of their attributes. most important attributes is text
+                        After that you should compare id in src_event with rid (resource-id) in candidates
+                        Also desc (content-desc) in candidates have description of that candidate use it to find similarity between src_event and candidate
 
-                        your response must contain just a json file and nothing more.
+                        give each chosen candidate a score, a number between 0 and 1 based on how much the candidate is similar to the src_event
+                        try to find at least one candidate with score more than 0
+                        don't include candidates with 0 score in your response
 
                         Dont write any code to find similar events based on your own intuition.
 
-                        src_event: {src_event}
-                        candidates: {candidates}
+                        src_event: {cls.compact(src_event, cls.SRC_FIELDS)}
+                        candidates (number: candidate):
+                        {candidate_lines}
+
+                        your response must be just a json array of {{"id": candidate number, "score": score}}, best first, without any addition
+                    """,
+                }
+            ],
+        )
+
+        content = response.choices[0].message["content"]
+        ranked, seen = [], set()
+        for i, score in cls.parse_answer(content, ["id"], cls.SCORE_PATTERN):
+            if 0 <= i < len(candidates) and i not in seen and score > 0:
+                seen.add(i)
+                ranked.append(dict(candidates[i], sim_score=score))
+        ranked.sort(key=lambda c: c["sim_score"], reverse=True)
+        return json.dumps(ranked)
+
+    @classmethod
+    def sort_candidates_batch(cls, src_events, candidate_lists, table):
+        """
+        Rank the candidates of several source events with a single ChatCompletion. Each candidate
+        is written to the prompt once, as a compact record, and referred to by its number.
+
+        :param src_events: the source events to rank candidates for
+        :param candidate_lists: for each source event, the signatures of its candidates
+        :param table: widget signature -> candidate
+        :return: for each source event, [{"signature": ..., "sim_score": ...}], best first
+        """
+        signatures = sorted({sig for sigs in candidate_lists for sig in sigs})
+        number = {sig: i for i, sig in enumerate(signatures)}
+        candidate_lines = "\n".join(
+            f"{i}: {cls.compact(table[sig], cls.CANDIDATE_FIELDS)}"
+            for i, sig in enumerate(signatures)
+        )
+        event_lines = "\n".join(
+            f"{j}: {cls.compact(src_event, cls.SRC_FIELDS)} candidates: {[number[sig] for sig in sigs]}"
+            for j, (src_event, sigs) in enumerate(zip(src_events, candidate_lists))
+        )
+
+        response = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=[
+                {
+                    "role": "user",
+                    "content": f"""
+                        For each numbered src_event below, compare it with its candidates and find the top 5 candidates that are most similar in terms of their attributes. most important attributes is text
+                        After that you should compare id in src_event with rid (resource-id) in candidates
+                        Also desc (content-desc) in candidates have description of that candidate use it to find similarity between src_event and candidate
+
+                        give each chosen candidate a score, a number between 0 and 1 based on how much the candidate is similar to the src_event
+                        try to find at least one candidate with score more than 0 for each src_event
+                        don't include candidates with 0 score in your response
+
+                        Dont write any code to find similar events based on your own intuition.
+
+                        candidates (number: candidate):
+                        {candidate_lines}
+
+                        src_events (number: src_event and the numbers of its candidates):
+                        {event_lines}
 
-                        your response should be an array of json without any addition
+                        your response must be just a json array of {{"event": src_event number, "id": candidate number, "score": score}} without any addition
                     """,
                 }
             ],
         )
 
-        return response.choices[0].message["content"]
+        content = response.choices[0].message["content"]
+        allowed = [set(sigs) for sigs in candidate_lists]
+        rankings = [{} for _ in candidate_lists]  # signature -> sim_score
+        for j, i, score in cls.parse_answer(
+            content, ["event", "id"], cls.BATCH_SCORE_PATTERN
+        ):
+            if 0 <= j < len(rankings) and 0 <= i < len(signatures) and score > 0:
+                if signatures[i] in allowed[j]:
+                    rankings[j].setdefault(signatures[i], score)
+        return [
+            sorted(
+                [{"signature": sig, "sim_score": s} for sig, s in ranking.items()],
+                key=lambda r: r["sim_score"],
+                reverse=True,
+            )
+            for ranking in rankings
+        ]
@@ -0,0 +1,81 @@
+import re
+import json
+import asyncio
+
+from BenGPT import BenGPT
+
+
+class OpenAIProvider:
+    """Ranks with BenGPT (a blocking ChatCompletion), run in a worker thread"""
+
+    def __init__(self):
+        self.sorter = BenGPT()
+
+    async def sort_candidates(self, src_event, candidates):
+        return await asyncio.to_thread(
+            self.sorter.sort_candidates, src_event, candidates
+        )
+
+    async def sort_candidates_batch(self, src_events, candidate_lists, table):
+        return await asyncio.to_thread(
+            self.sorter.sort_candidates_batch, src_events, candidate_lists, table
+        )
+
+
+class StubProvider:
+    """
+    Deterministic offline ranker with the same output format as BenGPT: the Jaccard similarity
+    between the words of a src_event and of a candidate, after an optional fixed delay that
+    stands in for the LLM latency
+    """
+
+    WORD = re.compile(r"[A-Za-z0-9]+")
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    @staticmethod
+    def words(values):
+        words = set()
+        for v in values:
+            if isinstance(v, list):
+                v = " ".join(v)
+            if isinstance(v, str):
+                words.update(w.lower() for w in StubProvider.WORD.findall(v))
+        return words
+
+    @staticmethod
+    def score(src_event, candidate):
+        src = StubProvider.words([src_event.get("id", ""), src_event.get("text", [])])
+        tgt = StubProvider.words(
+            [candidate.get(k, "") for k in ["resource-id", "text", "content-desc"]]
+        )
+        if not src or not tgt:
+            return 0.0
+        return round(len(src & tgt) / len(src | tgt), 4)
+
+    def rank(self, src_event, candidates, top=5):
+        """:return: [(index in candidates, sim_score)] of the top candidates with a positive score"""
+        scores = [
+            (i, StubProvider.score(src_event, c)) for i, c in enumerate(candidates)
+        ]
+        scores = [(i, s) for i, s in scores if s > 0]
+        scores.sort(key=lambda x: (-x[1], x[0]))
+        return scores[:top]
+
+    async def sort_candidates(self, src_event, candidates):
+        await asyncio.sleep(self.delay)
+        return json.dumps(
+            [
+                dict(candidates[i], sim_score=s)
+                for i, s in self.rank(src_event, candidates)
+            ]
+        )
+
+    async def sort_candidates_batch(self, src_events, candidate_lists, table):
+        await asyncio.sleep(self.delay)
+        rankings = []
+        for src_event, sigs in zip(src_events, candidate_lists):
+            ranked = self.rank(src_event, [table[sig] for sig in sigs])
+            rankings.append([{"signature": sigs[i], "sim_score": s} for i, s in ranked])
+        return rankings
@@ -0,0 +1,165 @@
+import re
+import json
+import hashlib
+from collections import OrderedDict
+
+# local imports
+from logger import logger
+
+
+class EmulatorSnapshots:
+    """Snapshots of the whole emulator (app data and UI state), taken through the emulator console"""
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def save(self, name):
+        return self.runner.adb(f"emu avd snapshot save {name}") == 0
+
+    def load(self, name):
+        return self.runner.adb(f"emu avd snapshot load {name}") == 0
+
+    def delete(self, name):
+        self.runner.adb(f"emu avd snapshot delete {name}")
+
+    def names(self):
+        """:return: the names of the snapshots on the emulator"""
+        output = self.runner.adb_output("emu avd snapshot list") or ""
+        # e.g., "--        transdroid_owncloud_3f2a9c1d0b4e   190M 2026-10-17 01:59:24   00:01:02.345"
+        return [
+            line.split()[1]
+            for line in output.splitlines()
+            if len(line.split()) > 1 and line.split()[0] != "ID"
+        ]
+
+
+class LocalSnapshots:
+    """
+    Stand-in for EmulatorSnapshots that only records snapshot names, to exercise Checkpoints without a device;
+    not selectable from the config
+    """
+
+    def __init__(self):
+        self.saved_names = set()
+        self.loaded = []
+
+    def save(self, name):
+        self.saved_names.add(name)
+        return True
+
+    def load(self, name):
+        self.loaded.append(name)
+        return name in self.saved_names
+
+    def delete(self, name):
+        self.saved_names.discard(name)
+
+    def names(self):
+        return sorted(self.saved_names)
+
+
+class Checkpoints:
+    """
+    Device states saved after executing a prefix of the target events, so that replaying the events can start
+    from the longest saved prefix instead of from a reset app. A state is saved every `every` events; beyond
+    max_checkpoints, the least recently used one is deleted.
+    Server-side data (refer to ExplorerUtil.populate_init_data) is not part of a checkpoint.
+    """
+
+    def __init__(self, backend, every=3, max_checkpoints=5, name_prefix="transdroid"):
+        self.backend = backend
+        self.every = every
+        self.max_checkpoints = max_checkpoints
+        self.name_prefix = name_prefix
+        # prefix key -> snapshot name, least recently used first
+        self.saved = OrderedDict()
+        self.restores, self.replayed_events = 0, 0
+
+    @classmethod
+    def from_config(cls, config, runner):
+        """
+        :return: Checkpoints on the emulator of runner if config["checkpoints"] is "emulator", or None if it is
+        disabled. Snapshots left over from a previous run of the app (e.g., one that crashed) are deleted
+        """
+        kind = config["checkpoints"]
+        if not kind:
+            return None
+        if kind != "emulator":
+            raise ValueError(f"Unknown checkpoints backend: {kind}")
+        checkpoints = cls(
+            EmulatorSnapshots(runner),
+            config["checkpoint_every"],
+            config["max_checkpoints"],
+            f"transdroid_{config['app']}",
+        )
+        checkpoints.delete_leftovers()
+        return checkpoints
+
+    def delete_leftovers(self):
+        """Delete the snapshots named by Checkpoints with name_prefix that are not saved by this instance"""
+        pattern = re.compile(re.escape(self.name_prefix) + r"_[0-9a-f]{12}")
+        saved = set(self.saved.values())
+        for name in self.backend.names():
+            if pattern.fullmatch(name) and name not in saved:
+                logger.info(f"Deleting leftover checkpoint {name}")
+                self.backend.delete(name)
+
+    @staticmethod
+    def prefix_keys(events):
+        """:return: a key for every prefix of events; keys[i] identifies events[: i + 1]"""
+        keys = []
+        h = hashlib.sha1()
+        for e in events:
+            h.update(json.dumps(e, sort_keys=True, default=str).encode("utf-8"))
+            keys.append(h.hexdigest())
+        return keys
+
+    def restore_nearest(self, events):
+        """
+        Restore the state after the longest saved prefix of events
+        :return: the length of the restored prefix; 0 if none was restored
+        """
+        keys = Checkpoints.prefix_keys(events)
+        for i in range(len(keys), 0, -1):
+            name = self.saved.get(keys[i - 1])
+            if name is None:
+                continue
+            if self.backend.load(name):
+                self.saved.move_to_end(keys[i - 1])
+                self.restores += 1
+                self.replayed_events += len(events) - i
+                logger.info(f"Checkpoint restored: {i}/{len(events)} events")
+                return i
+            logger.info(f"Failed to restore checkpoint {name}")
+            del self.saved[keys[i - 1]]
+        self.replayed_events += len(events)
+        return 0
+
+    def save(self, events):
+        """Save the current state as the one after events, if a checkpoint is due; :return: True if saved"""
+        if not events or len(events) % self.every:
+            return False
+        key = Checkpoints.prefix_keys(events)[-1]
+        if key in self.saved:
+            return False
+        name = f"{self.name_prefix}_{key[:12]}"
+        if not self.backend.save(name):
+            logger.info(f"Failed to save checkpoint {name}")
+            return False
+        self.saved[key] = name
+        while len(self.saved) > self.max_checkpoints:
+            _, oldest = self.saved.popitem(last=False)
+            self.backend.delete(oldest)
+        return True
+
+    def clear(self):
+        for name in self.saved.values():
+            self.backend.delete(name)
+        self.saved.clear()
+
+    def stats(self):
+        return {
+            "checkpoints": len(self.saved),
+            "restores": self.restores,
+            "replayed_events": self.replayed_events,
+        }
@@ -0,0 +1,91 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class DirectSource:
+    """
+    Read-only access to the page source straight from the UiAutomator2 server on the device, which Appium
+    forwards to systemPort on the host, skipping the Appium server in between. Appium still owns the
+    session and performs every action.
+    """
+
+    BASE_PATHS = ["", "/wd/hub"]  # of newer and older UiAutomator2 servers
+
+    def __init__(self, url, session_id, timeout=10):
+        self.url = url.rstrip("/")
+        self.session_id = session_id
+        self.timeout = timeout
+        self.base_path = None  # found by the first request
+
+    @classmethod
+    def for_driver(cls, driver, system_port):
+        return cls(f"http://127.0.0.1:{system_port}", driver.session_id)
+
+    def page_source(self):
+        """
+        :return: the XML of the current hierarchy, as driver.page_source; raises OSError on failure, and
+        FileNotFoundError if the first request finds the endpoint on no base path
+        """
+        base_paths = (
+            [self.base_path] if self.base_path is not None else DirectSource.BASE_PATHS
+        )
+        for base_path in base_paths:
+            url = f"{self.url}{base_path}/session/{self.session_id}/source"
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as resp:
+                    value = json.load(resp)["value"]
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    continue
+                raise
+            self.base_path = base_path
+            return value
+        if self.base_path is None:
+            raise FileNotFoundError(f"No page source endpoint at {self.url}")
+        raise OSError(f"Page source not found at {self.url}{self.base_path}")
+
+
+class StandInSourceServer:
+    """
+    A local server that speaks the page source protocol of the UiAutomator2 server, to run DirectSource
+    (and Runner with source_backend="direct") without a device; get_dom returns the XML to serve.
+    """
+
+    def __init__(self, get_dom, port=0):
+        get_source = get_dom
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.rstrip("/").split("/")
+                if len(parts) < 3 or parts[-1] != "source" or parts[-3] != "session":
+                    self.send_error(404)
+                    return
+                body = json.dumps({"sessionId": parts[-2], "value": get_source()})
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
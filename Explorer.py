@@ -14,35 +14,73 @@ from Runner import Runner
 from ResourceParser import ResourceParser
 from ExplorerUtil import ExplorerUtil
 from WidgetUtil import WidgetUtil
+from WidgetDB import WidgetDB
+from RankCache import RankCache
+from Checkpoints import Checkpoints
+from LookaheadPool import LookaheadPool
+from ModelCache import ModelCache
 from NavGraph import NavGraph
+from PathTrie import PathTrie
 from logger import logger
-from const import AUG_PREFIX, SNAPSHOT_FOLDER, EMPTY_CLASS
+from const import AUG_PREFIX, SNAPSHOT_FOLDER, EMPTY_CLASS, CACHE_FOLDER
 from EventAction import EventAction
 
 
 class Explorer:
     F_THRESHOLD = 0.005
 
-    def __init__(self, setting_path, test_name):
+    def __init__(
+        self,
+        setting_path,
+        test_name,
+        appium_port="4723",
+        udid=None,
+        system_port=None,
+        snapshot_folder=SNAPSHOT_FOLDER,
+    ):
+        """appium_port, udid and system_port select the device; refer to Runner"""
         self.config = ExplorerUtil.load_config(setting_path, test_name)
-        self.res_parser = ResourceParser(
-            self.config["resource_path"], self.config["model_path"]
+        self.snapshot_folder = snapshot_folder
+        if self.config["model_cache"]:
+            self.res_parser, self.graph = ModelCache().load(
+                self.config["resource_path"], self.config["model_path"]
+            )
+        else:
+            self.res_parser = ResourceParser(
+                self.config["resource_path"], self.config["model_path"]
+            )
+            self.graph = NavGraph(self.config["model_path"])
+        self.widgets = WidgetDB(
+            self.res_parser.get_widgets(), self.config["use_stopwords"]
         )
-        self.widgets = {
-            WidgetUtil.get_signature(w): w for w in self.res_parser.get_widgets()
-        }
-        self.graph = NavGraph(self.config["model_path"])
         self.runner = Runner(
             self.config["lanuch_package"],
             self.config["lanuch_activity"],
             self.config["reset_data"],
+            appium_port,
+            udid,
+            system_port,
+            self.config["wait"],
+            self.config["source_backend"],
+        )
+        self.runner.add_sleep_rules(self.config["extra_sleep"])
+        self.checkpoints = Checkpoints.from_config(self.config, self.runner)
+        self.lookahead_pool = LookaheadPool.from_config(self.config, self.runner)
+        self.rank_cache = (
+            RankCache(
+                os.path.join(CACHE_FOLDER, self.config["app"] + "_rankings.sqlite"),
+                self.config["rank_cache_ttl"],
+                self.config["rank_cache_max_entries"],
+            )
+            if self.config["rank_cache"]
+            else None
         )
         self.src_events = ExplorerUtil.load_events(
             self.config["web_test_path"].replace(".py", ".json")
         )
         self.src_events = self.merge_mouseover_events(self.src_events)
         self.invalid_events = defaultdict(list)
-        self.invalid_paths = set()
+        self.invalid_paths = PathTrie()
         self.current_src_idx = 0
         self.tgt_events, self.prev_tgt_events = [], []
         self.prev_f, self.f = -1, 0
@@ -66,12 +104,14 @@ class Explorer:
 
             logger.info("** Start a new round to find a better tgt event sequence **")
             ExplorerUtil.populate_init_data(
-                self.config["app"], self.config["test_name"]
+                self.config["app"], self.config["test_name"], self.runner.udid
             )
             # ExplorerUtil.env_reset(self.runner, self.config["app"], self.config["test_name"])
             self.prev_tgt_events = self.tgt_events
             self.tgt_events = []
             self.current_src_idx = 0
+            if self.config["invalid_paths_scope"] == "round":
+                self.invalid_paths.clear()
             is_lookahead = False
             self.is_backtrack = False
             while self.current_src_idx < len(self.src_events):
@@ -102,11 +142,13 @@ class Explorer:
                     )
                     self.backtrack()
                     continue
-                current_dom = self.runner.get_page_source()
+                current_screen = self.runner.get_screen()
                 current_package = self.runner.get_current_package()
                 current_activity = self.runner.get_current_activity(current_package)
                 if current_package == self.config["lanuch_package"]:
-                    self.update_widgets(current_package, current_activity, current_dom)
+                    self.update_widgets(
+                        current_package, current_activity, current_screen
+                    )
                 else:
                     logger.info(
                         f"Backtrack to the previous step due to out-of-scope Activity: {current_activity}"
@@ -131,18 +173,27 @@ class Explorer:
                     }
                     tgt_event = self.generate_event(match, src_event)
                 else:
+                    self.prefetch_rankings()
                     w_candidates = WidgetUtil.sort(
                         src_event,
-                        self.widgets.values(),
+                        self.widgets,
                         self.config["use_stopwords"],
                         self.config["expand_btn_to_text"],
+                        ranker=self.config["ranker"],
+                        rerank_top_k=self.config["rerank_top_k"],
+                        cache=self.rank_cache,
                     )
 
                     w_candidates = self.prioritize(
                         w_candidates, current_activity, src_event
                     )
 
-                    self.invalid_paths = set()
+                    if self.config["invalid_paths_scope"] == "event":
+                        self.invalid_paths.clear()
+                    invalid_keys = {
+                        WidgetUtil.equality_key(e)
+                        for e in self.invalid_events.get(self.current_src_idx, [])
+                    }
                     for i, (w, sim_score) in enumerate(w_candidates):
                         logger.info(
                             f"({i+1}/{len(w_candidates)}) Validating candidate (score: {sim_score}):"
@@ -150,14 +201,7 @@ class Explorer:
                         logger.info(
                             f'{str(w).encode("utf-8").decode("utf-8")}'
                         )  # for some weird chars in a1 apps
-                        if any(
-                            [
-                                WidgetUtil.is_equal(w, e)
-                                for e in self.invalid_events.get(
-                                    self.current_src_idx, []
-                                )
-                            ]
-                        ):
+                        if WidgetUtil.equality_key(w) in invalid_keys:
                             logger.info("Invalid widget/event. Skipped.")
                             continue
                         try:
@@ -170,6 +214,7 @@ class Explorer:
                             # todo: Never map two src EditText to the same tgt EditText, e.g., a51-a52-b52
                             if "clickable" not in w:  # a statically retrieved widget
                                 self.widgets.pop(WidgetUtil.get_signature(w), None)
+                            match["sim_score"] = sim_score
                             tgt_event = self.generate_event(match, src_event)
                             break
 
@@ -200,8 +245,38 @@ class Explorer:
             self.f = ExplorerUtil.fitness(self.tgt_events)
             logger.info(f"Current fitness: {self.f}, Prev: {self.prev_f}")
             logger.info(f"Current target events: {self.tgt_events}")
+            if self.rank_cache:
+                self.rank_cache.flush()
+                logger.info(f"Ranking cache: {self.rank_cache.stats()}")
+            logger.info(f"Waits: {self.runner.wait_stats()}")
+            logger.info(f"Device queries: {self.runner.round_trip_stats()}")
+            if self.checkpoints:
+                logger.info(f"Checkpoints: {self.checkpoints.stats()}")
             self.save_snapshot()
 
+    def prefetch_rankings(self):
+        """Rank the current and upcoming src events against the current wDB in one batch"""
+        if not self.config["prefetch_rankings"]:
+            return
+        upcoming = [
+            e
+            for e in self.src_events[
+                self.current_src_idx : self.current_src_idx
+                + self.config["prefetch_rankings"]
+            ]
+            if e.get("class", None) != EMPTY_CLASS
+            and e["action"] != EventAction.TEXT_NOT_PRESENT.value
+        ]
+        WidgetUtil.prefetch(
+            upcoming,
+            self.widgets,
+            self.config["use_stopwords"],
+            self.config["expand_btn_to_text"],
+            ranker=self.config["ranker"],
+            rerank_top_k=self.config["rerank_top_k"],
+            cache=self.rank_cache,
+        )
+
     def backtrack(self):
         self.current_src_idx -= 1
         invalid_event = self.tgt_events.pop()
@@ -209,23 +284,22 @@ class Explorer:
         self.is_backtrack = True
 
     def execute_target_events(self):
-        if (
-            self.runner.get_current_package()
-            == "com.google.android.googlequicksearchbox"
-        ):  # close voice search prompt
-            os.system("adb shell am force-stop com.google.android.googlequicksearchbox")
-        elif (
-            self.runner.get_current_activity(pkg="")
-            == "com.android.internal.app.ResolverActivity"
-        ):
-            os.system(
-                "adb shell input keyevent 4"
-            )  # Back btn to turn off file upload prompt
-        ExplorerUtil.populate_init_data(self.config["app"], self.config["test_name"])
-        ExplorerUtil.env_reset(
-            self.runner, self.config["app"], self.config["test_name"]
+        ExplorerUtil.close_system_prompts(self.runner)
+        restored = (
+            self.checkpoints.restore_nearest(self.tgt_events) if self.checkpoints else 0
         )
-        self.runner.execute(self.tgt_events, nav_graph=self.graph)
+        if restored:
+            self.runner.invalidate_screen()
+        else:
+            ExplorerUtil.populate_init_data(
+                self.config["app"], self.config["test_name"], self.runner.udid
+            )
+            ExplorerUtil.env_reset(
+                self.runner, self.config["app"], self.config["test_name"]
+            )
+        self.runner.execute(self.tgt_events[restored:], nav_graph=self.graph)
+        if self.checkpoints:
+            self.checkpoints.save(self.tgt_events)
 
     def execute_last_match(self):
         if self.tgt_events:
@@ -233,26 +307,20 @@ class Explorer:
                 k: v for k, v in self.tgt_events[-1].items() if k != "steppings"
             }
             self.runner.execute([event_to_run], nav_graph=self.graph)
+            if self.checkpoints:
+                self.checkpoints.save(self.tgt_events)
 
-    def update_widgets(self, pkg, act, dom):
+    def update_widgets(self, pkg, act, screen):
         if act not in self.graph.G:
             logger.info(f"Graph node added: {act}")
             self.graph.G.add_node(act)
-        widgets = WidgetUtil.retrieve_widgets(pkg, act, dom)
+        widgets = WidgetUtil.retrieve_widgets(pkg, act, screen)
         prev_num_w = len(self.widgets)
         for w in widgets:
-            signature = WidgetUtil.get_signature(w)
-            if signature not in self.widgets:
-                self.widgets[signature] = w
+            if self.widgets.add(w):
                 logger.debug(f"wDB widget added: {w}")
-            # remove the signature from widgets if w is statically cached previously
-            w_static = {
-                k: v
-                for k, v in w.items()
-                if k in WidgetUtil.FEATURE_KEYS[:4] + ["package", "node"]
-            }
-            w_static_signature = WidgetUtil.get_signature(w_static)
-            popped = self.widgets.pop(w_static_signature, None)
+            # remove w's statically retrieved counterpart if it was cached previously
+            popped = self.widgets.pop_static(w)
             if popped:
                 logger.debug(f"wDB popped static widget: {popped}")
         num_w = len(self.widgets)
@@ -262,10 +330,21 @@ class Explorer:
     def check_reachability(self, widget, current_activity):
         n_from = current_activity
         n_to = widget["node"]
-        paths = self.graph.paths_between_nodes(n_from, n_to)
-        logger.info(f"({len(paths)} to validate) From {n_from} to {n_to}.")
-        for i, path in enumerate(paths[:10]):
-            logger.info(f"({i+1}/{len(paths)}) Validating path:")
+        max_paths = 10
+        # paths are generated on demand, shortest first, without those under a known invalid prefix
+        paths = self.graph.paths_between_nodes(
+            n_from,
+            n_to,
+            k=max_paths,
+            max_length=self.config["max_path_length"],
+            stream=True,
+            is_pruned=self.invalid_paths.has_prefix_of,
+            pruning_scope=self.invalid_paths.generation,
+            max_pulled=self.config["max_paths_generated"],
+        )
+        logger.info(f"(up to {max_paths} to validate) From {n_from} to {n_to}.")
+        for i, path in enumerate(paths):
+            logger.info(f"({i+1}/{max_paths}) Validating path:")
             logger.info(path)
             match, is_pruned = self.validate_path(path, widget)
             if match:
@@ -277,15 +356,15 @@ class Explorer:
 
     def validate_path(self, path, w_target):
         """:return: match widget (dict or None), is_pruned (True/False)"""
-        if NavGraph.path_signature(path) in self.invalid_paths:
+        if path in self.invalid_paths:
             logger.info("Known invalid path. Stopped.")
             return None, True
-        for i in range(1, len(path) + 1):
-            if NavGraph.path_signature(path[:i]) in self.invalid_paths:
-                logger.info("Path with known invalid prefix. Stopped.")
-                logger.debug(path[:i])
-                self.invalid_paths.add(NavGraph.path_signature(path))
-                return None, True
+        invalid_prefix = self.invalid_paths.prefix_of(path)
+        if invalid_prefix:
+            logger.info("Path with known invalid prefix. Stopped.")
+            logger.debug(invalid_prefix)
+            self.invalid_paths.add(path)
+            return None, True
 
         steppings = []
         for i, (node, label) in enumerate(path):  # Start following the path
@@ -296,11 +375,11 @@ class Explorer:
             e_type, locator_type, locator, action = label.split(":")
             # w_stepping = WidgetUtil.locate_widget(self.runner.get_page_source(), e_type, locator_type, locator)
             w_stepping = WidgetUtil.locate_widget(
-                self.runner.get_page_source(), e_type, {locator_type: locator}
+                self.runner.get_screen(), e_type, {locator_type: locator}
             )
             if not w_stepping:
                 logger.info("Unable to execute the event. Stopped.")
-                self.invalid_paths.add(NavGraph.path_signature(path[: i + 1]))
+                self.invalid_paths.add(path[: i + 1])
                 return None, False
             self.run_stepping_and_update(steppings, w_stepping, action.lower())
 
@@ -309,7 +388,7 @@ class Explorer:
             "menu_group" in w_target and w_target["menu_group"]
         ):  # w_target is a menu node from static analysis
             w_stepping = WidgetUtil.locate_widget(
-                self.runner.get_page_source(), "GUI", {"content-desc": "More options"}
+                self.runner.get_screen(), "GUI", {"content-desc": "More options"}
             )
             if w_stepping:
                 logger.info(
@@ -334,7 +413,7 @@ class Explorer:
                     locators[a] = w_target[a]
         if not locators:
             assert False, "Never happen"
-        w = WidgetUtil.locate_widget(self.runner.get_page_source(), "GUI", locators)
+        w = WidgetUtil.locate_widget(self.runner.get_screen(), "GUI", locators)
         if not w:
             return None, False
         src_event = self.src_events[self.current_src_idx]
@@ -351,9 +430,9 @@ class Explorer:
         w_stepping["node"] = self.runner.get_current_activity(w_stepping["package"])
         steppings.append(w_stepping)
         self.runner.execute([w_stepping], nav_graph=graph)
-        dom, pkg = self.runner.get_page_source(), self.runner.get_current_package()
+        screen, pkg = self.runner.get_screen(), self.runner.get_current_package()
         act = self.runner.get_current_activity(pkg)
-        self.update_widgets(pkg, act, dom)
+        self.update_widgets(pkg, act, screen)
 
     def generate_event(self, widget, src_event):
         widget["action"] = src_event["action"]
@@ -393,52 +472,56 @@ class Explorer:
         current_node = self.runner.get_current_activity(
             self.runner.get_current_package()
         )
-        clickables = []
-        self.runner.driver.implicitly_wait(
-            0.5
-        )  # no wait for the quick check of clickables
-        for w in self.widgets.values():
-            if (
-                "clickable" in w
-                and w["clickable"] == "true"
-                and w["node"] == current_node
-            ):
-                ele, _ = self.runner.get_element_from_screen(w)
-                if ele:
-                    clickables.append(w)
-        self.runner.driver.implicitly_wait(self.runner.implicit_wait_default)
+        candidates = self.widgets.select(clickable=True, node=current_node)
+        on_screen = self.widgets_on_screen(candidates)
+        clickables = [w for w in candidates if on_screen[WidgetUtil.get_signature(w)]]
         logger.info(f"{len(clickables)} clickables to look ahead")
+        if self.lookahead_pool and len(clickables) > 1:
+            for clickable in clickables:
+                clickable["action"] = "click"
+            results = self.lookahead_pool.explore(
+                self.config, self.tgt_events, clickables
+            )
+            for (
+                result
+            ) in results:  # in the order of clickables, as the sequential lookahead
+                if result:
+                    for edge in result["edges"]:
+                        self.graph.add_edge(*edge)
+                    self.update_widgets(result["pkg"], result["act"], result["screen"])
+            return
         for i, clickable in enumerate(clickables):
             logger.info(f"({i+1}/{len(clickables)}) {clickable}")
             self.execute_target_events()
             clickable["action"] = "click"
             try:
                 self.runner.execute([clickable], nav_graph=self.graph)
-                dom, pkg = (
-                    self.runner.get_page_source(),
+                screen, pkg = (
+                    self.runner.get_screen(),
                     self.runner.get_current_package(),
                 )
                 act = self.runner.get_current_activity(pkg)
-                self.update_widgets(pkg, act, dom)
+                self.update_widgets(pkg, act, screen)
             except NoSuchElementException:
                 logger.info("NoSuchElementException when lookahead(). Skipped.")
                 pass
 
+    def widgets_on_screen(self, widgets):
+        """:return: {signature: whether the widget is on the current screen}, resolved on one page_source"""
+        screen = self.runner.get_screen()
+        return {WidgetUtil.get_signature(w): screen.has_element(w) for w in widgets}
+
     def prioritize(self, candidates, current_node, src_event):
         # Prioritize the best candidates if they are in the current screen
         best = [(c, score) for (c, score) in candidates if score == candidates[0][1]]
         if len(best) > 1:
             first, second = [], []
-            self.runner.driver.implicitly_wait(
-                0.5
-            )  # no wait for the quick check of current widgets
+            on_screen = self.widgets_on_screen([c for c, _ in best])
             for c, score in best:
-                ele, _ = self.runner.get_element_from_screen(c)
-                if ele and c["node"] == current_node:
+                if on_screen[WidgetUtil.get_signature(c)] and c["node"] == current_node:
                     first.append((c, score))
                 else:
                     second.append((c, score))
-            self.runner.driver.implicitly_wait(self.runner.implicit_wait_default)
             if "tag" in src_event:  # prefer the same class as the tag
                 src_widget_type = src_event["tag"].lower()
                 same, different = [], []
@@ -459,10 +542,20 @@ class Explorer:
             k: pickle.dumps(v)
             for k, v in self.__dict__.items()
             if k
-            not in {"config", "res_parser", "runner", "src_events", "current_src_idx"}
+            not in {
+                "config",
+                "res_parser",
+                "runner",
+                "src_events",
+                "current_src_idx",
+                "rank_cache",
+                "checkpoints",
+                "lookahead_pool",
+            }
         }
+        os.makedirs(self.snapshot_folder, exist_ok=True)
         with open(
-            os.path.join(SNAPSHOT_FOLDER, self.config["test_name"] + ".pkl"), "wb"
+            os.path.join(self.snapshot_folder, self.config["test_name"] + ".pkl"), "wb"
         ) as f:
             pickle.dump(cache, f)
 
@@ -521,5 +614,9 @@ if __name__ == "__main__":
     #     explorer.load_snapshot(cache)
     explorer.run()
     explorer.save()
+    if explorer.lookahead_pool:
+        explorer.lookahead_pool.quit()
+    if explorer.checkpoints:  # replay the transferred events from scratch
+        explorer.checkpoints.clear()
     logger.info("Testing transferred events")
     explorer.execute_target_events()
@@ -1,5 +1,5 @@
 import json
-import time
+import re
 import requests
 from statistics import mean
 from EventAction import ORACLE_EVENT_ACTIONS
@@ -24,6 +24,36 @@ class ExplorerUtil:
         config["lanuch_activity"] = setting["launch_setting"][launch_default][1]
         config["resource_path"] = setting["resource_path"]
         config["model_path"] = setting["model_path"]
+        # the parsed model and resources are cached in CACHE_FOLDER; refer to ModelCache
+        config["model_cache"] = setting.get("model_cache", True)
+        # "llm", "local" or "local+llm"; refer to WidgetUtil.sort
+        config["ranker"] = setting.get("ranker", "llm")
+        config["rerank_top_k"] = setting.get("rerank_top_k", 5)
+        # rankings are cached on disk across rounds and runs; refer to RankCache
+        config["rank_cache"] = setting.get("rank_cache", True)
+        config["rank_cache_ttl"] = setting.get("rank_cache_ttl", 7 * 24 * 3600)
+        config["rank_cache_max_entries"] = setting.get("rank_cache_max_entries", 50000)
+        # number of src events (from the current one) to rank in one batch; 0 to rank one by one
+        config["prefetch_rankings"] = setting.get("prefetch_rankings", 10)
+        # how long known invalid navigation paths are kept: "event" (the candidates of a src event),
+        # "round" or "run"
+        config["invalid_paths_scope"] = setting.get("invalid_paths_scope", "event")
+        # longest navigation path tried, in (node, event) steps, and how many paths to generate at most
+        config["max_path_length"] = setting.get("max_path_length", 8)
+        config["max_paths_generated"] = setting.get("max_paths_generated", 200)
+        # condition-based waits of Runner, e.g., {"timeout": 10}; refer to Runner.WAIT_DEFAULTS
+        config["wait"] = setting.get("wait", {})
+        # app-specific rules in the format of widgets_for_extra_sleep.json; refer to Runner.add_sleep_rules
+        config["extra_sleep"] = setting.get("extra_sleep", {})
+        # device states to replay target events from; "emulator" (snapshots) or None.
+        # Not for tests that change server-side data, which checkpoints do not restore
+        config["checkpoints"] = setting.get("checkpoints", None)
+        config["checkpoint_every"] = setting.get("checkpoint_every", 3)
+        config["max_checkpoints"] = setting.get("max_checkpoints", 5)
+        # more devices to look ahead in parallel, e.g., [{"udid": "emulator-5556", "appium_port": "4725", "system_port": 8201}]
+        config["lookahead_devices"] = setting.get("lookahead_devices", [])
+        # "appium", or "direct" to read page sources from the UiAutomator2 server; refer to Runner
+        config["source_backend"] = setting.get("source_backend", "appium")
         for k, v in setting["transfer_setting"][test_name].items():
             config[k] = v
         return config
@@ -53,19 +83,54 @@ class ExplorerUtil:
             )  # don't clear app data
             if app == "owncloud":
                 logger.info("Test Setup: Wait for the sync with server")
-                time.sleep(5)
+                runner.wait_until_stable(runner.wait_settings["sync_timeout"], "sync")
                 logger.info("Test Setup: Waiting finished")
         else:
             runner.driver.reset()
             runner.driver.implicitly_wait(3)
             runner.driver.implicitly_wait(runner.implicit_wait_default)
+        runner.invalidate_screen()
 
     @staticmethod
-    def populate_init_data(app, test_name):
+    def close_system_prompts(runner):
+        if (
+            runner.get_current_package() == "com.google.android.googlequicksearchbox"
+        ):  # close voice search prompt
+            runner.adb("shell am force-stop com.google.android.googlequicksearchbox")
+            runner.invalidate_screen()
+        elif (
+            runner.get_current_activity(pkg="")
+            == "com.android.internal.app.ResolverActivity"
+        ):
+            runner.adb(
+                "shell input keyevent 4"
+            )  # Back btn to turn off file upload prompt
+            runner.invalidate_screen()
+
+    @staticmethod
+    def tenant_name(udid):
+        """:return: the ownCloud user name of the device udid, e.g., 192.168.1.5_5555 for 192.168.1.5:5555"""
+        # ownCloud user names may only contain letters, digits and "_.@-"
+        return re.sub(r"[^A-Za-z0-9_.@-]", "_", udid)
+
+    @staticmethod
+    def populate_init_data(app, test_name, tenant=None):
+        """
+        :param tenant: whose server-side data to reset, e.g., the udid of the device; the devices of parallel
+        Explorers log in to the app with different accounts (tenants), refer to owncloud_service.py.
+        All the data is reset if None
+        """
         logger.info("Test Setup: Populating data")
         if app == "owncloud":
             if test_name in {"aug_TestCreateLink"}:
                 from web_test.owncloud.test_data import IP_ADDR
 
-                requests.get(f"http://{IP_ADDR}:5000/owncloud-reset")
+                if tenant is None:
+                    requests.get(f"http://{IP_ADDR}:5000/owncloud-reset")
+                else:
+                    resp = requests.get(
+                        f"http://{IP_ADDR}:5000/owncloud-reset/"
+                        f"{ExplorerUtil.tenant_name(tenant)}"
+                    )
+                    resp.raise_for_status()
         logger.info("Test Setup: Finished populating data")
@@ -0,0 +1,127 @@
+import numpy as np
+
+# local imports
+from StrUtil import StrUtil
+
+
+class LocalRanker:
+    """
+    In-process candidate ranking: bag-of-token cosine similarity between a source event and
+    candidate widgets, computed for all candidates at once with NumPy.
+    Tokens are interned into ids; the features of a widget are {feature: (token ids, norm)},
+    which WidgetDB computes once per widget (WidgetDB.features_of).
+    """
+
+    # the widget attributes matched against the id/text of a source event
+    MAIN_FEATURES = ["resource-id", "text", "content-desc"]
+    # the widget attributes matched against the sibling text of a source event
+    CONTEXT_FEATURES = ["parent_text", "sibling_text"]
+    CONTEXT_WEIGHT = 0.2
+    BUTTON_CLASSES = {"android.widget.Button", "android.widget.ImageButton"}
+    TOKEN_IDS = {}  # token -> id, shared by all widgets and events
+
+    @staticmethod
+    def tokenize(s_type, s, use_stopwords=True):
+        try:
+            return StrUtil.tokenize(s_type, s, use_stopwords)
+        except AssertionError:  # e.g., a resource-id with no word characters
+            return []
+
+    @staticmethod
+    def intern(tokens):
+        """:return: token ids and the L2 norm of the token counts"""
+        ids = tuple(
+            LocalRanker.TOKEN_IDS.setdefault(t, len(LocalRanker.TOKEN_IDS))
+            for t in tokens
+        )
+        counts = {}
+        for i in ids:
+            counts[i] = counts.get(i, 0) + 1
+        return ids, float(np.sqrt(sum(c * c for c in counts.values())))
+
+    @classmethod
+    def src_features(cls, src_event, use_stopwords=True):
+        """:return: main (id and text) and context (sibling text) features of src_event"""
+        main = cls.tokenize("resource-id", src_event.get("id", ""), use_stopwords)
+        main += cls.tokenize("text", src_event.get("text", []), use_stopwords)
+        context = []
+        for key in ["prev_sibling_text", "next_sibling_text"]:
+            context += cls.tokenize("text", src_event.get(key, []), use_stopwords)
+        return cls.intern(main), cls.intern(context)
+
+    @classmethod
+    def widget_features(cls, w, use_stopwords=True):
+        """:return: {feature: (token ids, norm)} for the MAIN_FEATURES and CONTEXT_FEATURES of w"""
+        return {
+            f: cls.intern(cls.tokenize(f, w.get(f, ""), use_stopwords))
+            for f in cls.MAIN_FEATURES + cls.CONTEXT_FEATURES
+        }
+
+    @classmethod
+    def similarity(cls, src, features, feature):
+        """Cosine similarity between the src (token ids, norm) and a feature of every candidate"""
+        src_ids, src_norm = src
+        weights = np.zeros(len(cls.TOKEN_IDS))
+        np.add.at(weights, list(src_ids), 1 / src_norm)
+        lengths = [len(fs[feature][0]) for fs in features]
+        ids = np.fromiter(
+            (i for fs in features for i in fs[feature][0]),
+            dtype=np.int64,
+            count=sum(lengths),
+        )
+        owner = np.repeat(np.arange(len(features)), lengths)
+        dots = np.bincount(owner, weights=weights[ids], minlength=len(features))
+        norms = np.array([fs[feature][1] for fs in features])
+        return np.divide(dots, norms, out=np.zeros(len(features)), where=norms > 0)
+
+    @classmethod
+    def rank(
+        cls,
+        src_event,
+        candidates,
+        use_stopwords=True,
+        expand_btn_to_text=False,
+        top=12,
+        features=None,
+    ):
+        """
+        :param expand_btn_to_text: also match the src id/text against the parent/sibling text of buttons,
+        which is where the label of an ImageButton usually is
+        :param features: widget_features of each candidate, if precomputed (e.g., by WidgetDB)
+        :return: [(widget, sim_score)] of the top candidates with a positive score, best first
+        """
+        candidates = list(candidates)
+        main, context = cls.src_features(src_event, use_stopwords)
+        if not candidates or not (main[0] or context[0]):
+            return []
+        if features is None:
+            features = [cls.widget_features(w, use_stopwords) for w in candidates]
+
+        # cosine similarity of the best matching feature of each candidate
+        scores = np.zeros(len(candidates))
+        if main[0]:
+            scores = np.max(
+                [cls.similarity(main, features, f) for f in cls.MAIN_FEATURES], axis=0
+            )
+            if expand_btn_to_text:
+                is_btn = np.array(
+                    [w["class"] in cls.BUTTON_CLASSES for w in candidates]
+                )
+                btn_scores = np.max(
+                    [cls.similarity(main, features, f) for f in cls.CONTEXT_FEATURES],
+                    axis=0,
+                )
+                scores = np.where(is_btn, np.maximum(scores, btn_scores), scores)
+        if context[0]:
+            context_scores = np.max(
+                [cls.similarity(context, features, f) for f in cls.CONTEXT_FEATURES],
+                axis=0,
+            )
+            scores = (
+                1 - cls.CONTEXT_WEIGHT
+            ) * scores + cls.CONTEXT_WEIGHT * context_scores
+
+        order = np.argsort(-scores, kind="stable")[:top]
+        return [
+            (candidates[i], round(float(scores[i]), 4)) for i in order if scores[i] > 0
+        ]
@@ -0,0 +1,125 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from selenium.common.exceptions import NoSuchElementException
+
+# local imports
+from Runner import Runner
+from ExplorerUtil import ExplorerUtil
+from logger import logger
+
+
+class EdgeRecorder:
+    """Stands in for NavGraph in Runner.execute on a lookahead worker; the edges are added to the graph on merge"""
+
+    def __init__(self):
+        self.edges = []
+
+    def add_edge(self, n_from, n_to, label):
+        self.edges.append((n_from, n_to, label))
+
+
+class LookaheadPool:
+    """
+    Runners on several devices that look ahead in parallel: the clickables are split across the runners,
+    each of which replays the target events from a reset app, clicks its clickable and records the screen
+    it lands on and the edges it traverses. Results come back in the order of the clickables, so that
+    merging them into the wDB and the graph does not depend on which device finished first.
+    """
+
+    def __init__(self, runners):
+        self.runners = runners
+
+    @classmethod
+    def from_config(cls, config, runner):
+        """
+        :param runner: the Runner of the Explorer, which looks ahead too
+        :return: LookaheadPool of runner and the devices of config["lookahead_devices"], or None if there are none
+        """
+        if not config["lookahead_devices"]:
+            return None
+        runners = [runner]
+        for device in config["lookahead_devices"]:
+            r = Runner(
+                config["lanuch_package"],
+                config["lanuch_activity"],
+                config["reset_data"],
+                device["appium_port"],
+                device["udid"],
+                device.get("system_port"),
+                config["wait"],
+                config["source_backend"],
+            )
+            r.add_sleep_rules(config["extra_sleep"])
+            runners.append(r)
+        return cls(runners)
+
+    def explore(self, config, tgt_events, clickables):
+        """
+        :return: [{"edges", "pkg", "act", "screen"} or None if the clickable was not found], one per clickable
+        """
+        assignments = [
+            list(range(len(clickables)))[i :: len(self.runners)]
+            for i in range(len(self.runners))
+        ]
+        results = [None] * len(clickables)
+        with ThreadPoolExecutor(max_workers=len(self.runners)) as pool:
+            futures = [
+                pool.submit(
+                    LookaheadPool.explore_on,
+                    runner,
+                    config,
+                    tgt_events,
+                    [(i, clickables[i]) for i in indices],
+                    len(clickables),
+                )
+                for runner, indices in zip(self.runners, assignments)
+                if indices
+            ]
+            for future in futures:
+                for i, result in future.result():
+                    results[i] = result
+        return results
+
+    @staticmethod
+    def explore_on(runner, config, tgt_events, clickables, total):
+        """Look ahead the (index, clickable) pairs on one runner (run in a worker thread)"""
+        results = []
+        for i, clickable in clickables:
+            logger.info(f"({i+1}/{total}) on {runner.udid}: {clickable}")
+            recorder = EdgeRecorder()
+            try:
+                ExplorerUtil.close_system_prompts(runner)
+                ExplorerUtil.populate_init_data(
+                    config["app"], config["test_name"], runner.udid
+                )
+                ExplorerUtil.env_reset(runner, config["app"], config["test_name"])
+                runner.execute(tgt_events, nav_graph=recorder)
+                runner.execute([clickable], nav_graph=recorder)
+                screen, pkg = runner.get_screen(), runner.get_current_package()
+                act = runner.get_current_activity(pkg)
+                results.append(
+                    (
+                        i,
+                        {
+                            "edges": recorder.edges,
+                            "pkg": pkg,
+                            "act": act,
+                            "screen": screen,
+                        },
+                    )
+                )
+            except NoSuchElementException:
+                logger.info("NoSuchElementException when lookahead(). Skipped.")
+                results.append((i, None))
+            except Exception:  # a failing device must not lose the results of the others
+                logger.error(traceback.format_exc())
+                results.append((i, None))
+        return results
+
+    def quit(self):
+        """Quit the drivers of the additional runners; the first one belongs to the Explorer"""
+        for runner in self.runners[1:]:
+            try:
+                runner.driver.quit()
+            except Exception:
+                pass
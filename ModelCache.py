@@ -0,0 +1,110 @@
+import os
+import time
+import marshal
+import hashlib
+
+# local imports
+from ResourceParser import ResourceParser
+from NavGraph import NavGraph
+from const import CACHE_FOLDER
+from logger import logger
+
+
+class ModelCache:
+    """
+    Compiled cache of an app model: the navigation graph (with resource ids already resolved to names) and
+    the parsed resources (package, string table, layout/menu maps and static widgets), stored in one
+    marshal file per (resource_path, model_path). The cache is valid as long as the size and mtime of
+    every source file are unchanged; otherwise the model is parsed again and the cache rewritten.
+    """
+
+    VERSION = 1
+    MODEL_FILES = [
+        "graph.txt",
+        "rIdToName.json",
+        "rLayoutToName.json",
+        "nodeToLayout.json",
+        "rMenuToName.json",
+        "nodeToMenu.json",
+    ]
+    RESOURCE_FILES = ["AndroidManifest.xml", "res/values/strings.xml"]
+    RESOURCE_FOLDERS = ["res/layout", "res/menu"]
+
+    def __init__(self, folder=CACHE_FOLDER):
+        self.folder = folder
+
+    def cache_path(self, resource_path, model_path):
+        key = os.path.abspath(resource_path) + "\n" + os.path.abspath(model_path)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        name = os.path.basename(os.path.normpath(model_path))
+        return os.path.join(self.folder, f"{name}_{digest}.model")
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None
+
+    @classmethod
+    def fingerprint(cls, resource_path, model_path):
+        """:return: [(source file, (size, mtime) or None if missing)]"""
+        files = [os.path.join(model_path, f) for f in cls.MODEL_FILES]
+        files += [os.path.join(resource_path, f) for f in cls.RESOURCE_FILES]
+        for folder in cls.RESOURCE_FOLDERS:
+            folder = os.path.join(resource_path, folder)
+            if os.path.isdir(folder):
+                files += sorted(
+                    e.path
+                    for e in os.scandir(folder)
+                    if e.is_file() and e.name.endswith(".xml")
+                )
+        return [(f, cls.stat(f)) for f in files]
+
+    def load(self, resource_path, model_path):
+        """:return: ResourceParser and NavGraph of the app model, from the cache if it is up to date"""
+        start = time.time()
+        path = self.cache_path(resource_path, model_path)
+        fingerprint = ModelCache.fingerprint(resource_path, model_path)
+        model = ModelCache.read(path)
+        if (
+            model
+            and model["version"] == ModelCache.VERSION
+            and model["fingerprint"] == fingerprint
+        ):
+            res_parser = ResourceParser.from_state(model["resources"])
+            graph = NavGraph(model_path, edges=model["edges"])
+            logger.info(f"Model loaded from {path} in {time.time() - start:.2f}s")
+            return res_parser, graph
+
+        res_parser = ResourceParser(resource_path, model_path, self.folder)
+        graph = NavGraph(model_path)
+        logger.info(f"Model parsed in {time.time() - start:.2f}s")
+        if os.path.exists(resource_path) and os.path.exists(model_path):
+            ModelCache.write(
+                path,
+                {
+                    "version": ModelCache.VERSION,
+                    "fingerprint": fingerprint,
+                    "resources": res_parser.get_state(),
+                    "edges": graph.get_edges(),
+                },
+            )
+        return res_parser, graph
+
+    @staticmethod
+    def read(path):
+        try:
+            with open(path, "rb") as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def write(path, model):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            marshal.dump(model, f)
+        os.replace(tmp_path, path)  # atomic, for concurrent Explorers of the same app
@@ -1,5 +1,7 @@
+import heapq
 import networkx as nx
 from os.path import join, exists
+from itertools import islice
 import json
 import matplotlib.pyplot as plt
 import os
@@ -10,9 +12,17 @@ class NavGraph:
     LOCATOR_TYPES = ["ID", "TEXT", "CONTENT-DESC"]
     ACTIONS = ["CLICK"]
 
-    def __init__(self, model_path):
+    def __init__(self, model_path, edges=None):
+        """:param edges: [(n_from, n_to, label)] to build the graph from instead of graph.txt; see ModelCache"""
         self.G = nx.MultiDiGraph()
+        # (n_from, n_to, pruning scope) -> ([paths generated so far], generator of the rest); see iter_paths
+        self.path_cache = {}
+        # DiGraph snapshot of G for path generation; see get_hop_graph
+        self.hop_graph = None
         self.graphName = model_path.rpartition("/")[-1]
+        if edges is not None:
+            self.G.add_edges_from(edges)
+            return
         if not exists(join(model_path, "graph.txt")):
             return
         with open(join(model_path, "rIdToName.json"), "r") as f:
@@ -48,44 +58,223 @@ class NavGraph:
                                     ":".join([e_type, "ID", rid_name[r_id], "CLICK"]),
                                 )
 
-    def paths_between_nodes(self, n_from, n_to):
-        if n_from not in self.G or n_to not in self.G:
-            return []
-        paths_map = {}  # hash map to avoid duplicate path
+    def get_edges(self):
+        """:return: [(n_from, n_to, label)] of all edges"""
+        return list(self.G.edges(keys=True))
+
+    def __getstate__(self):
+        # the path index holds generators, which cannot be pickled (e.g., by Explorer.save_snapshot)
+        state = self.__dict__.copy()
+        state["path_cache"], state["hop_graph"] = {}, None
+        return state
+
+    def add_edge(self, n_from, n_to, label):
+        """
+        Add an edge discovered at runtime and invalidate the cached paths it may change.
+        :return: True if the edge is new
+        """
+        if self.G.has_edge(n_from, n_to, key=label):
+            return False
+        self.G.add_edge(n_from, n_to, label)
+        self.hop_graph = None
+        if n_from == n_to:  # only the self-loop variants of paths ending at n_to change
+            stale = [k for k in self.path_cache if k[1] == n_to]
+        else:  # new paths (or a new top event) only between ancestors of n_from and descendants of n_to
+            sources = nx.ancestors(self.G, n_from) | {n_from}
+            targets = nx.descendants(self.G, n_to) | {n_to}
+            stale = [k for k in self.path_cache if k[0] in sources and k[1] in targets]
+        for k in stale:
+            del self.path_cache[k]
+        return True
+
+    def get_hop_graph(self):
+        """A DiGraph of G with the sorted events and the top event of each (u, v) as edge attributes"""
+        if self.hop_graph is None:
+            hop_graph = nx.DiGraph()
+            hop_graph.add_nodes_from(self.G)
+            for u, v in set(self.G.edges()):
+                events = sorted(self.G.get_edge_data(u, v).keys())
+                hop_graph.add_edge(
+                    u, v, events=events, event=NavGraph.top_event(events)
+                )
+            self.hop_graph = hop_graph
+        return self.hop_graph
+
+    @staticmethod
+    def shortest_path(hop_graph, source, target, ignore_nodes=(), ignore_edges=()):
+        """:return: a shortest node list from source to target (BFS) avoiding ignore_nodes/edges, or None"""
+        parents = {source: None}
+        frontier = [source]
+        while frontier:
+            next_frontier = []
+            for u in frontier:
+                for v in hop_graph.successors(u):
+                    if v in parents or v in ignore_nodes or (u, v) in ignore_edges:
+                        continue
+                    parents[v] = u
+                    if v == target:
+                        node_list = [v]
+                        while parents[node_list[-1]] is not None:
+                            node_list.append(parents[node_list[-1]])
+                        return node_list[::-1]
+                    next_frontier.append(v)
+            frontier = next_frontier
+        return None
+
+    @staticmethod
+    def generate_paths(hop_graph, n_from, n_to, is_pruned=None):
+        """
+        Yield the paths from n_from to n_to in non-decreasing length (Yen's k-shortest simple paths),
+        each followed by its variants ending with a self-loop event of n_to.
+        :param is_pruned: a predicate on path prefixes, true for every extension of a prefix it is true for
+            (e.g., PathTrie.has_prefix_of). The search does not branch off from a pruned prefix, nor extend
+            a prefix by a step that prunes it, so the paths under a pruned prefix are not generated at all;
+            paths that are pruned past their deviation may still be yielded.
+        """
+        self_loops = (
+            hop_graph[n_to][n_to]["events"] if hop_graph.has_edge(n_to, n_to) else []
+        )
         if n_from == n_to:
-            if self.G.get_edge_data(n_from, n_to):
-                events = set(self.G.get_edge_data(n_from, n_to).keys())
-                for e in events:
-                    path = [(n_from, e), (n_to, None)]
-                    paths_map[NavGraph.path_signature(path)] = path
-            paths = list(paths_map.values())
-            paths.insert(0, [(n_from, None), (n_to, None)])
-            return paths
-        else:
-            for node_list in nx.all_simple_paths(self.G, source=n_from, target=n_to):
-                path = []
-                for i in range(len(node_list) - 1):
-                    u, v = node_list[i], node_list[i + 1]
-                    events = set(self.G.get_edge_data(u, v).keys())
-                    e = NavGraph.top_event(
-                        events
-                    )  # only consider/prioritize one event between u and v for now
-                    path.append((u, e))
-                path.append((n_to, None))
-                paths_map[NavGraph.path_signature(path)] = path
-                # if n_to has self-loops, repeat them
-                if self.G.get_edge_data(n_to, n_to):
-                    events = set(self.G.get_edge_data(n_to, n_to).keys())
-                    for e in events:
-                        path_end_repeated = path[:]
-                        path_end_repeated.pop()
-                        path_end_repeated.append((n_to, e))
-                        paths_map[
-                            NavGraph.path_signature(path_end_repeated)
-                        ] = path_end_repeated
-            paths = list(paths_map.values())
-            paths.sort(key=lambda x: len(x))  # prefer shorter paths
-            return paths
+            yield [(n_from, None), (n_to, None)]
+            for e in self_loops:
+                yield [(n_from, e), (n_to, None)]
+            return
+        # nodes may be added to G (e.g., by Explorer.update_widgets) after the snapshot was taken
+        if n_from not in hop_graph or n_to not in hop_graph:
+            return
+
+        def to_path(node_list):
+            # only consider/prioritize one event between u and v for now
+            return [
+                (u, hop_graph[u][v]["event"]) for u, v in zip(node_list, node_list[1:])
+            ]
+
+        pruned_edges = set()
+        if is_pruned:
+            pruned_edges = {
+                (n_from, v)
+                for v in hop_graph.successors(n_from)
+                if is_pruned([(n_from, hop_graph[n_from][v]["event"])])
+            }
+        node_list = NavGraph.shortest_path(hop_graph, n_from, n_to, (), pruned_edges)
+        accepted, candidates = [], []
+        seen = {tuple(node_list)} if node_list else set()
+        while node_list is not None:
+            accepted.append(node_list)
+            path = to_path(node_list)
+            yield path + [(n_to, None)]
+            # if n_to has self-loops, repeat them
+            for e in self_loops:
+                yield path + [(n_to, e)]
+            # deviations from each node of node_list, sharing the path up to that node (the root)
+            for i, spur in enumerate(node_list[:-1]):
+                root = node_list[: i + 1]
+                if is_pruned and i and is_pruned(path[:i]):
+                    break  # and so are the longer roots
+                ignore_edges = {
+                    (p[i], p[i + 1]) for p in accepted if p[: i + 1] == root
+                }
+                if is_pruned:
+                    ignore_edges.update(
+                        (spur, v)
+                        for v in hop_graph.successors(spur)
+                        if is_pruned(path[:i] + [(spur, hop_graph[spur][v]["event"])])
+                    )
+                spur_list = NavGraph.shortest_path(
+                    hop_graph, spur, n_to, set(root[:-1]), ignore_edges
+                )
+                if spur_list is None:
+                    continue
+                candidate = root[:-1] + spur_list
+                if tuple(candidate) not in seen:
+                    seen.add(tuple(candidate))
+                    heapq.heappush(candidates, (len(candidate), len(seen), candidate))
+            node_list = heapq.heappop(candidates)[2] if candidates else None
+
+    def iter_paths(
+        self,
+        n_from,
+        n_to,
+        is_pruned=None,
+        pruning_scope=None,
+        max_length=None,
+        max_pulled=None,
+    ):
+        """
+        Lazily yield the paths from n_from to n_to, shortest first. Generated paths are cached per
+        (n_from, n_to), so repeated queries replay them before generating more. If add_edge invalidates
+        the query while it is being iterated, it continues with the new paths not yielded yet.
+        :param is_pruned: a predicate on path prefixes (refer to generate_paths); pruned paths are not yielded
+        :param pruning_scope: a key under which is_pruned only ever prunes more (e.g., a generation of its invalid set);
+            the paths generated with pruning are cached per scope, and not at all without one
+        :param max_length: stop at the first path of more (node, event) steps
+        :param max_pulled: stop after taking this many paths from the cache or the generator, pruned ones included
+        """
+        if n_from not in self.G or n_to not in self.G:
+            return
+        cached = not is_pruned or pruning_scope is not None
+        key = (n_from, n_to, pruning_scope if is_pruned else None)
+        yielded = set()
+        pulled = 0
+        while True:
+            entry = self.path_cache.get(key) if cached else None
+            if entry is None:
+                generator = NavGraph.generate_paths(
+                    self.get_hop_graph(), n_from, n_to, is_pruned
+                )
+                entry = ([], generator)
+                if cached:
+                    # a new scope may have fewer pruned prefixes; drop the paths generated under the old ones
+                    for k in [k for k in self.path_cache if k[:2] == key[:2]]:
+                        if k[2] is not None:
+                            del self.path_cache[k]
+                    self.path_cache[key] = entry
+            paths, generator = entry
+            i = 0
+            while not cached or self.path_cache.get(key) is entry:
+                if max_pulled is not None and pulled >= max_pulled:
+                    return
+                if i == len(paths):
+                    path = next(generator, None)
+                    if path is None:
+                        return
+                    paths.append(path)
+                path = paths[i]
+                i += 1
+                pulled += 1
+                if max_length is not None and len(path) > max_length:
+                    return
+                signature = NavGraph.path_signature(path)
+                if signature in yielded:
+                    continue
+                yielded.add(signature)
+                if not is_pruned or not is_pruned(path):
+                    yield path
+
+    def paths_between_nodes(
+        self,
+        n_from,
+        n_to,
+        k=None,
+        max_length=None,
+        stream=False,
+        is_pruned=None,
+        pruning_scope=None,
+        max_pulled=None,
+    ):
+        """
+        :param k: the number of paths to return, all if None
+        :param max_length: the maximum number of (node, event) steps of a path, unbounded if None
+        :param stream: return a generator that produces the paths on demand instead of a list
+        :param is_pruned: a predicate on path prefixes; the paths under a pruned prefix are not generated,
+            and pruned paths do not count towards k. Refer to iter_paths for pruning_scope and max_pulled
+        :return: the k shortest paths from n_from to n_to, e.g., [[("node1", "action1"), ("node2", None)]]
+        """
+        paths = self.iter_paths(
+            n_from, n_to, is_pruned, pruning_scope, max_length, max_pulled
+        )
+        paths = islice(paths, k)
+        return paths if stream else list(paths)
 
     @staticmethod
     def path_signature(path):
@@ -0,0 +1,60 @@
+import itertools
+
+
+class PathTrie:
+    """
+    A set of navigation paths (refer to NavGraph for the format, e.g., [("node1", "action1"), ("node2", None)])
+    stored as a trie over their (node, event) steps, so that prefix queries are linear in the path length.
+    """
+
+    GENERATIONS = itertools.count()
+
+    def __init__(self, paths=()):
+        # step -> child node; None -> True marks the end of a stored path
+        self.root = {}
+        self.size = 0
+        # changes only on clear, so the stored paths only grow within a generation; refer to NavGraph.iter_paths
+        self.generation = next(PathTrie.GENERATIONS)
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        """:return: True if path is new"""
+        node = self.root
+        for step in path:
+            node = node.setdefault(tuple(step), {})
+        if None in node:
+            return False
+        node[None] = True
+        self.size += 1
+        return True
+
+    def prefix_of(self, path):
+        """:return: the shortest stored path that is a prefix of (or equal to) path, or None"""
+        node = self.root
+        for i, step in enumerate(path):
+            node = node.get(tuple(step))
+            if node is None:
+                return None
+            if None in node:
+                return path[: i + 1]
+        return None
+
+    def has_prefix_of(self, path):
+        return self.prefix_of(path) is not None
+
+    def clear(self):
+        self.root = {}
+        self.size = 0
+        self.generation = next(PathTrie.GENERATIONS)
+
+    def __contains__(self, path):
+        node = self.root
+        for step in path:
+            node = node.get(tuple(step))
+            if node is None:
+                return False
+        return None in node
+
+    def __len__(self):
+        return self.size
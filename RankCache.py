@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class RankCache:
+    """
+    Disk-backed cache of candidate rankings. A ranking is keyed by a hash of the ranker options,
+    the source event and the sorted signatures of the candidates, and stored as [[signature, sim_score]].
+    Entries expire after ttl seconds; beyond max_entries the least recently used ones are evicted.
+    Reads do not write: access times are kept in memory and written on put and flush.
+    """
+
+    def __init__(self, path=":memory:", ttl=None, max_entries=50000):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits, self.misses = 0, 0
+        self.accessed = {}  # key -> last access time not written yet
+        self.conn = sqlite3.connect(path, timeout=30)  # shared by parallel Explorers
+        if path != ":memory:":  # readers do not wait for the writer, nor block it
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rankings "
+            "(key TEXT PRIMARY KEY, ranking TEXT, created REAL, accessed REAL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def key(options, src_event, signatures):
+        canonical = json.dumps(
+            [options, src_event, sorted(signatures)],
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """:return: [(signature, sim_score)] or None"""
+        row = self.conn.execute(
+            "SELECT ranking, created FROM rankings WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if not row or (self.ttl is not None and now - row[1] > self.ttl):
+            self.misses += 1
+            return None  # an expired entry is deleted by evict
+        self.hits += 1
+        self.accessed[key] = now
+        return [tuple(r) for r in json.loads(row[0])]
+
+    def __contains__(self, key):
+        """Membership test that leaves the hit/miss counters alone"""
+        row = self.conn.execute(
+            "SELECT created FROM rankings WHERE key = ?", (key,)
+        ).fetchone()
+        return bool(row) and (self.ttl is None or time.time() - row[0] <= self.ttl)
+
+    def put(self, key, ranking):
+        now = time.time()
+        self.accessed.pop(key, None)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO rankings VALUES (?, ?, ?, ?)",
+            (key, json.dumps(ranking, ensure_ascii=False), now, now),
+        )
+        self.write_accessed()
+        self.evict()
+        self.conn.commit()
+
+    def write_accessed(self):
+        """Write the access times collected by get, for evict to see, without committing"""
+        if self.accessed:
+            self.conn.executemany(
+                "UPDATE rankings SET accessed = MAX(accessed, ?) WHERE key = ?",
+                [(t, key) for key, t in self.accessed.items()],
+            )
+            self.accessed.clear()
+
+    def flush(self):
+        if self.accessed:
+            self.write_accessed()
+            self.conn.commit()
+
+    def evict(self):
+        if self.ttl is not None:
+            self.conn.execute(
+                "DELETE FROM rankings WHERE created < ?", (time.time() - self.ttl,)
+            )
+        (n,) = self.conn.execute("SELECT COUNT(*) FROM rankings").fetchone()
+        if n > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM rankings WHERE key IN "
+                "(SELECT key FROM rankings ORDER BY accessed LIMIT ?)",
+                (n - self.max_entries,),
+            )
+
+    def stats(self):
+        (n,) = self.conn.execute("SELECT COUNT(*) FROM rankings").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": n}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
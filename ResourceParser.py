@@ -1,10 +1,12 @@
 import os
 import json
+import marshal
+import hashlib
 import lxml.etree
-from bs4 import BeautifulSoup
-from lxml.etree import tostring
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from logger import logger
+from const import CACHE_FOLDER
 
 
 class ResourceParser:
@@ -16,14 +18,22 @@ class ResourceParser:
         "android.support.design.widget.FloatingActionButton",
         "com.google.android.material.floatingactionbutton.FloatingActionButton",
     ]
+    FAB_TYPES = [  # FloatingActionButton will appear as ImageButton by UI Automator
+        "android.support.design.widget.FloatingActionButton",
+        "com.google.android.material.floatingactionbutton.FloatingActionButton",
+    ]
     CLASS_PREFIX = (
         "android.widget."  # to accommodate the class name reported by UI Automator
     )
+    # parse layouts in a process pool only when there are this many (uncached) ones
+    MIN_LAYOUTS_FOR_POOL = 200
 
-    def __init__(self, resource_path, model_path):
+    def __init__(self, resource_path, model_path, cache_folder=CACHE_FOLDER):
+        """:param cache_folder: where parsed layouts are cached by content hash; None to disable"""
         if os.path.exists(resource_path) and os.path.exists(model_path):
             self.resource_path = resource_path
             self.model_path = model_path
+            self.cache_folder = cache_folder
             self.pkg = self.extract_pkg()
             self.string_text = self.extract_string_text()
             self.layout_name = self.load(os.path.join(model_path, "rLayoutToName.json"))
@@ -39,6 +49,16 @@ class ResourceParser:
         else:
             self.widgets = {}
 
+    def get_state(self):
+        """:return: the parsed resources, as plain dicts/lists; see ModelCache"""
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_state(cls, state):
+        parser = cls.__new__(cls)
+        parser.__dict__.update(state)
+        return parser
+
     def extract_pkg(self):
         e = lxml.etree.parse(os.path.join(self.resource_path, "AndroidManifest.xml"))
         pkg = e.xpath("/manifest")[0].attrib["package"]
@@ -56,22 +76,85 @@ class ResourceParser:
         e = lxml.etree.parse(os.path.join(self.resource_path, "res/values/strings.xml"))
         for node in e.xpath("//resources/string"):
             if "name" in node.attrib:
-                soup = BeautifulSoup(tostring(node), "lxml")
+                text = node.xpath("string()").strip()
                 sname = node.attrib["name"]
                 assert sname not in string_text
-                string_text[sname] = soup.text.strip() if soup.text.strip() else sname
+                string_text[sname] = text if text else sname
         for node in e.xpath("//resources/item"):
             if (
                 "name" in node.attrib
                 and "type" in node.attrib
                 and node.attrib["type"] == "string"
             ):
-                soup = BeautifulSoup(tostring(node), "lxml")
+                text = node.xpath("string()").strip()
                 sname = node.attrib["name"]
                 assert sname not in string_text
-                string_text[sname] = soup.text.strip() if soup.text.strip() else sname
+                string_text[sname] = text if text else sname
         return string_text
 
+    @staticmethod
+    def parse_layout(content):
+        """
+        Single pass over a layout file (run in worker processes, so it only returns plain data).
+        :return: the included layouts, and [(widget type, [(attr, raw value)])] ordered by
+        WIDGET_TYPES_FOR_LAYOUT, then by document order
+        """
+        includes = []
+        by_type = {w_type: [] for w_type in ResourceParser.WIDGET_TYPES_FOR_LAYOUT}
+        for node in lxml.etree.fromstring(content).iter():
+            if node.tag == "include":  # e.g., <include layout="@layout/content_main" />
+                includes.append(node.attrib["layout"])
+            elif node.tag in by_type:
+                by_type[node.tag].append(list(node.attrib.items()))
+        widgets = [(t, items) for t, nodes in by_type.items() for items in nodes]
+        return includes, widgets
+
+    def layout_cache_path(self):
+        name = os.path.basename(os.path.normpath(self.resource_path))
+        return os.path.join(self.cache_folder, f"{name}_layouts.marshal")
+
+    def parse_layouts(self, layout_folder, xmls):
+        """
+        Parse the layout files, reusing the results cached (by content hash) for unchanged files
+        :return: {xml: parse_layout result}
+        """
+        cache = {}
+        if self.cache_folder:
+            try:
+                with open(self.layout_cache_path(), "rb") as f:
+                    cache = marshal.load(f)
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        contents, digests = {}, {}
+        for xml in xmls:
+            with open(os.path.join(layout_folder, xml), "rb") as f:
+                contents[xml] = f.read()
+            digests[xml] = hashlib.sha1(contents[xml]).hexdigest()
+        to_parse = [xml for xml in xmls if digests[xml] not in cache]
+        if len(to_parse) >= ResourceParser.MIN_LAYOUTS_FOR_POOL:
+            with ProcessPoolExecutor() as pool:
+                results = pool.map(
+                    ResourceParser.parse_layout,
+                    [contents[xml] for xml in to_parse],
+                    chunksize=32,
+                )
+                parsed = dict(zip(to_parse, results))
+        else:
+            parsed = {
+                xml: ResourceParser.parse_layout(contents[xml]) for xml in to_parse
+            }
+        logger.info(f"{len(parsed)}/{len(xmls)} layouts parsed")
+        for xml, result in parsed.items():
+            cache[digests[xml]] = result
+        if self.cache_folder and parsed:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            tmp_path = f"{self.layout_cache_path()}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                # only keep the entries of the current layouts
+                marshal.dump({d: cache[d] for d in digests.values()}, f)
+            os.replace(tmp_path, self.layout_cache_path())
+        return {xml: cache[digests[xml]] for xml in xmls}
+
     def extract_widgets(self):
         parent = {}
         layout_folder = os.path.join(self.resource_path, "res/layout")
@@ -80,18 +163,16 @@ class ResourceParser:
             for f in os.listdir(layout_folder)
             if os.path.isfile(os.path.join(layout_folder, f)) and f.endswith(".xml")
         ]
+        layouts = self.parse_layouts(layout_folder, xmls)
 
-        # first pass to get layout hierarchy
+        # layout hierarchy
         for xml in xmls:
             current = xml.split(".")[0]
-            e = lxml.etree.parse(os.path.join(layout_folder, xml))
-            for node in e.xpath(
-                "//include"
-            ):  # e.g., <include layout="@layout/content_main" />
-                child = self.decode(node.attrib["layout"])
-                parent[child] = current
-
-        # second pass to get widgets from a layout
+            includes, _ = layouts[xml]
+            for layout in includes:
+                parent[self.decode(layout)] = current
+
+        # widgets from a layout
         attrs = {  # the attr name in xml and reported by UI Automator
             "id": "resource-id",
             "text": "text",
@@ -108,25 +189,20 @@ class ResourceParser:
                 current in self.layout_id
                 and self.layout_id[current] in self.layout_node
             ):
-                e = lxml.etree.parse(os.path.join(layout_folder, xml))
-                for w_type in ResourceParser.WIDGET_TYPES_FOR_LAYOUT:
-                    for node in e.xpath("//" + w_type):
-                        w = self.xml_to_widget(attrs, node)
-                        if w:
-                            # FloatingActionButton will appear as ImageButton by UI Automator
-                            if w_type in [
-                                "android.support.design.widget.FloatingActionButton",
-                                "com.google.android.material.floatingactionbutton.FloatingActionButton",
-                            ]:
-                                w_type = "ImageButton"
-                            w["class"] = ResourceParser.CLASS_PREFIX + w_type
-                            w["layout"] = current
-                            w["node"] = self.layout_node[self.layout_id[current]]
-                            w["package"] = self.pkg
-                            for v in attrs.values():
-                                if v not in w:
-                                    w[v] = ""
-                            widgets.append(w)
+                _, layout_widgets = layouts[xml]
+                for w_type, items in layout_widgets:
+                    w = self.attrib_to_widget(attrs, items)
+                    if w:
+                        if w_type in ResourceParser.FAB_TYPES:
+                            w_type = "ImageButton"
+                        w["class"] = ResourceParser.CLASS_PREFIX + w_type
+                        w["layout"] = current
+                        w["node"] = self.layout_node[self.layout_id[current]]
+                        w["package"] = self.pkg
+                        for v in attrs.values():
+                            if v not in w:
+                                w[v] = ""
+                        widgets.append(w)
         return widgets
 
     def decode(self, value):
@@ -202,8 +278,11 @@ class ResourceParser:
         return menu_items
 
     def xml_to_widget(self, attrs, xml_node):
+        return self.attrib_to_widget(attrs, xml_node.attrib.items())
+
+    def attrib_to_widget(self, attrs, items):
         w = {}
-        for k, v in xml_node.attrib.items():
+        for k, v in items:
             # e.g., {http://schemas.android.com/apk/res/android}id, @id/ok
             k = k.split("}")[1] if k.startswith("{") else k
             if k in attrs:
@@ -4,21 +4,75 @@ from appium.webdriver.common.appiumby import AppiumBy as MobileBy
 from selenium.common.exceptions import NoSuchElementException
 import time
 import os
+import re
 import json
+import subprocess
+from collections import defaultdict
 
 # local import
 from logger import logger
 from EventAction import EventAction
 from const import EMPTY_CLASS
+from ScreenSnapshot import ScreenSnapshot
+from DirectSource import DirectSource
+from AdbShell import AdbShell
 from appium.options.android import UiAutomator2Options
 
 appium_server_url = "http://localhost"
+SLEEP_RULES_PATH = "widgets_for_extra_sleep.json"
+# e.g., "mFocusedApp=ActivityRecord{4b8a2c1 u0 com.owncloud.android/.ui.activity.FileDisplayActivity t12}",
+# tried in the order of the UiAutomator2 driver (appium-adb) for current_package/current_activity;
+# mCurrentFocus when there is no focused app, as mCurrentFocus may be a dialog or the IME window instead
+FOCUS_PATTERNS = [
+    re.compile(r"mFocusedApp=.*Record\{.*\s([^\s/}]+)/([^\s/},]+),?(\s[^\s/}]+)*\}"),
+    re.compile(r"mCurrentFocus=Window\{.*\s([^\s/}]+)/([^\s/}]+)\}"),
+]
 
 
 class Runner:
-    def __init__(self, pkg, act, reset=True, appium_port="4723", udid=None):
-        desired_caps = Runner.set_caps(pkg, act, reset, udid)
-        os.system("adb root")  # get root access on the emulator
+    # condition-based waits: poll every interval seconds, for at most timeout seconds; the UI is
+    # stable when its hierarchy is unchanged for stable_for seconds
+    WAIT_DEFAULTS = {
+        "interval": 0.25,
+        "stable_for": 0.5,
+        "timeout": 7,
+        "sync_timeout": 5,  # for the app to sync with its server on launch, e.g., ownCloud
+    }
+    # consecutive failures of the direct page source before Runner reads page sources from Appium only
+    MAX_DIRECT_SOURCE_FAILURES = 3
+
+    def __init__(
+        self,
+        pkg,
+        act,
+        reset=True,
+        appium_port="4723",
+        udid=None,
+        system_port=None,
+        wait_settings=None,
+        source_backend="appium",
+    ):
+        """
+        :param udid: the device to run on; required when several devices are connected
+        :param system_port: the UiAutomator2 server port; must differ between parallel sessions
+        :param wait_settings: per-app overrides of WAIT_DEFAULTS
+        :param source_backend: "appium", or "direct" to read page sources from the UiAutomator2 server
+        without the Appium server in between (refer to DirectSource); actions always go through Appium
+        """
+        self.udid = udid
+        self.wait_settings = {**Runner.WAIT_DEFAULTS, **(wait_settings or {})}
+        # reason -> [number of waits, seconds waited, number of timeouts]
+        self.waits = defaultdict(lambda: [0, 0.0, 0])
+        # extra sleep rules ({class: [[widget, sleep_time]]}) added by the app config, and the ones of
+        # SLEEP_RULES_PATH (reloaded when the file changes), indexed by get_sleep_rule
+        self.app_sleep_rules = {}
+        self.sleep_rules_mtime = None
+        self.load_sleep_rules()
+        desired_caps = Runner.set_caps(pkg, act, reset, udid, system_port)
+        self.shell = None
+        self.adb("root")  # get root access on the emulator
+        # "adb shell" commands of this device go through one long-lived shell
+        self.shell = AdbShell.for_device(udid)
         capabilities_options = UiAutomator2Options().load_capabilities(desired_caps)
         self.driver = webdriver.Remote(
             command_executor=appium_server_url + ":" + appium_port,
@@ -27,10 +81,24 @@ class Runner:
         self.implicit_wait_default = 7
         self.driver.implicitly_wait(self.implicit_wait_default)
         self.supported_actions = {a.value for a in EventAction}
+        # the screen state epoch, bumped on every action; the ScreenSnapshot and the focused
+        # (package, activity) are fetched at most once per epoch
+        self.epoch = 0
+        self.screen = None
+        self.focus = None
+        # what -> [number of queries, number of device round trips]
+        self.round_trips = defaultdict(lambda: [0, 0])
+        self.direct_source = None
+        self.direct_source_failures = 0  # consecutive; refer to fetch_page_source
+        if source_backend == "direct":
+            self.direct_source = DirectSource.for_driver(
+                self.driver,
+                self.driver.capabilities.get("systemPort", system_port or 8200),
+            )
         # self.databank = Databank()
 
     @staticmethod
-    def set_caps(app_package, app_activity, reset=True, udid=None):
+    def set_caps(app_package, app_activity, reset=True, udid=None, system_port=None):
         caps = {
             "platformName": "Android",
             "deviceName": "Android Emulator",
@@ -41,8 +109,46 @@ class Runner:
         }
         if udid:
             caps["udid"] = udid
+        if system_port:
+            caps["systemPort"] = int(system_port)
         return caps
 
+    def adb_output(self, command):
+        """:return: the stdout of an adb command, or None if it fails"""
+        if command.startswith("shell ") and self.shell:
+            status, output = self.shell.run(command[len("shell ") :])
+            if (
+                status is not None
+            ):  # else not started in the shell; run it with an adb process instead
+                return output if status == 0 else None
+        serial = f"-s {self.udid} " if self.udid else ""
+        try:
+            result = subprocess.run(
+                f"adb {serial}{command}",
+                shell=True,
+                capture_output=True,
+                text=True,
+                timeout=10,
+            )
+        except subprocess.TimeoutExpired:
+            return None
+        return result.stdout if result.returncode == 0 else None
+
+    def adb(self, command):
+        """
+        Run an adb command (e.g., "shell input keyevent 4") on the device of this Runner
+        :return: the exit status, 0 on success
+        """
+        if command.startswith("shell ") and self.shell:
+            status, _ = self.shell.run(command[len("shell ") :])
+            if (
+                status is not None
+            ):  # else not started in the shell; run it with an adb process instead
+                return status
+        if self.udid:
+            return os.system(f"adb -s {self.udid} {command}")
+        return os.system(f"adb {command}")
+
     def execute(self, events, nav_graph=None):
         events_to_run = []
         for event in events:
@@ -69,7 +175,7 @@ class Runner:
                 continue
             if action == EventAction.TEXT_NOT_PRESENT.value:
                 # todo: get back to the screen of anchor widget
-                assert " ".join(event["action_args"]) not in self.driver.page_source
+                assert " ".join(event["action_args"]) not in self.get_screen().dom
                 continue
 
             # action performed on the selected element
@@ -82,6 +188,7 @@ class Runner:
                 assert ele.is_displayed()
                 continue
             elif action == EventAction.CLEAR.value:
+                self.invalidate_screen()
                 ele.clear()
                 continue
             elif action == EventAction.IS_ATTR_EQUAL.value:
@@ -92,6 +199,7 @@ class Runner:
                 continue
             elif action == EventAction.CLICK.value:
                 n_from = self.get_current_activity(self.get_current_package())
+                self.invalidate_screen()
                 ele.click()
                 n_to = self.get_current_activity(self.get_current_package())
                 if nav_graph:
@@ -112,6 +220,7 @@ class Runner:
                         logger.debug(f"Try to add edge: {n_from} -> {n_to} ({label})")
                         nav_graph.add_edge(n_from, n_to, label)
             elif action == EventAction.SEND_KEYS.value:
+                self.invalidate_screen()
                 is_executed = self.run_system_input(event, ele)
                 if not is_executed:
                     ele.send_keys(event["action_args"][0])
@@ -119,24 +228,84 @@ class Runner:
                 assert False, "Unsupported Action"
 
             self.additional_sleep(event)
+            # the screen may have changed after it was queried during the action, e.g., n_to of a click
+            self.invalidate_screen()
 
     def hide_keyboard(self):
         if self.driver.is_keyboard_shown:
             try:
                 self.driver.hide_keyboard()
+                self.invalidate_screen()
             except WebDriverException:
                 pass
 
     def get_current_activity(self, pkg):
-        act = self.driver.current_activity
+        act = self.get_focus()[1]
         return pkg + act if act.startswith(".") else act
 
     def get_page_source(self):
-        self.hide_keyboard()
+        return self.get_screen().dom
+
+    def get_screen(self):
+        """Fetch and cache the current screen; the snapshot is reused until the next action"""
+        self.round_trips["page_source"][0] += 1
+        if self.screen is None:
+            self.hide_keyboard()
+            self.screen = ScreenSnapshot(self.fetch_page_source())
+            self.round_trips["page_source"][1] += 1
+        return self.screen
+
+    def fetch_page_source(self):
+        if self.direct_source:
+            try:
+                source = self.direct_source.page_source()
+                self.direct_source_failures = 0
+                return source
+            except FileNotFoundError as e:  # the server has no such endpoint
+                logger.info(f"No direct page source, back to Appium: {e!r}")
+                self.direct_source = None
+            except (OSError, ValueError, KeyError) as e:
+                self.direct_source_failures += 1
+                logger.info(f"Direct page source failed, from Appium this time: {e!r}")
+                if self.direct_source_failures >= Runner.MAX_DIRECT_SOURCE_FAILURES:
+                    logger.info("Direct page source failed repeatedly, back to Appium")
+                    self.direct_source = None
         return self.driver.page_source
 
+    def invalidate_screen(self):
+        """Start a new epoch; to be called on every action that may change the screen"""
+        self.epoch += 1
+        self.screen = None
+        self.focus = None
+
     def get_current_package(self):
-        return self.driver.current_package
+        return self.get_focus()[0]
+
+    def get_focus(self):
+        """:return: (package, activity) of the focused window, fetched at most once per epoch"""
+        self.round_trips["focus"][0] += 1
+        if self.focus is None:
+            self.focus = self.fetch_focus()
+        return self.focus
+
+    def fetch_focus(self):
+        """Package and activity from one dumpsys, instead of an Appium call (itself a dumpsys) for each"""
+        self.round_trips["focus"][1] += 1
+        dumpsys = self.adb_output("shell dumpsys window displays") or ""
+        for pattern in FOCUS_PATTERNS:
+            for line in dumpsys.splitlines():
+                m = pattern.search(line)
+                if m:
+                    return m.group(1), m.group(2)
+        self.round_trips["focus"][1] += 2
+        return self.driver.current_package, self.driver.current_activity
+
+    def round_trip_stats(self):
+        """:return: {what: {"queries", "round_trips"}}; queries - round_trips is the number saved by the epoch cache"""
+        return {
+            what: {"queries": queries, "round_trips": trips}
+            for what, (queries, trips) in self.round_trips.items()
+        }
 
     def get_element_from_screen(self, event):
         attr_for_label = None
@@ -186,21 +355,143 @@ class Runner:
             logger.info(f"No element found for event: {event}")
             return None, attr_for_label
 
+    def add_sleep_rules(self, rules):
+        """:param rules: {class: [[widget, sleep_time]]}, as in SLEEP_RULES_PATH; they take precedence over the file"""
+        for clz, widgets in rules.items():
+            self.app_sleep_rules.setdefault(clz, []).extend(widgets)
+        self.load_sleep_rules()
+
+    def load_sleep_rules(self):
+        """Index the rules by (class, resource-id, node); None if a rule has no such attribute"""
+        try:
+            self.sleep_rules_mtime = os.stat(SLEEP_RULES_PATH).st_mtime_ns
+            with open(SLEEP_RULES_PATH, "r", encoding="utf-8") as f:
+                file_rules = json.load(f)
+        except FileNotFoundError:
+            self.sleep_rules_mtime, file_rules = None, {}
+        self.sleep_rules = defaultdict(list)  # key -> [(order, widget, sleep_time)]
+        order = 0
+        for rules in [self.app_sleep_rules, file_rules]:
+            for clz, widgets in rules.items():
+                for w, sleep_time in widgets:
+                    key = (clz, w.get("resource-id"), w.get("node"))
+                    self.sleep_rules[key].append((order, w, sleep_time))
+                    order += 1
+
+    def get_sleep_rule(self, event):
+        """:return: the sleep_time of the first rule that matches event, or None"""
+        try:
+            mtime = os.stat(SLEEP_RULES_PATH).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.sleep_rules_mtime:
+            self.load_sleep_rules()
+        clz, rid, node = event["class"], event.get("resource-id"), event.get("node")
+        match = None
+        for key in {
+            (clz, rid, node),
+            (clz, rid, None),
+            (clz, None, node),
+            (clz, None, None),
+        }:
+            for order, w, sleep_time in self.sleep_rules.get(key, ()):
+                if match and match[0] < order:
+                    break
+                if all(event.get(k) == v for k, v in w.items()):
+                    match = (order, sleep_time)
+                    break
+        return match[1] if match else None
+
     def additional_sleep(self, event):
         """
-        Determine additional sleep time for specific events,
-        e.g., after clicking the "posts" btn to load all posts in WordPress
+        Wait for specific events to take effect, e.g., after clicking the "posts" btn to load all posts in WordPress.
+        A rule waits until the UI is stable, for at most its number of seconds ("default" for the implicit wait),
+        or, if it is {"until": {attr: value}, "timeout": seconds}, until an expected element is shown.
         """
-        with open("widgets_for_extra_sleep.json", "r", encoding="utf-8") as f:
-            special = json.load(f)
-        for clz, widgets in special.items():
-            if event["class"] == clz:
-                for w, sleep_time in widgets:
-                    if all(event[k] == v for k, v in w.items()):
-                        if sleep_time == "default":
-                            sleep_time = self.implicit_wait_default
-                        time.sleep(sleep_time)
-                        return
+        sleep_time = self.get_sleep_rule(event)
+        if sleep_time is None:
+            return
+        if sleep_time == "default":
+            sleep_time = self.implicit_wait_default
+        if isinstance(sleep_time, dict):
+            self.wait_until(
+                lambda: self.has_element(sleep_time["until"]),
+                sleep_time.get("timeout"),
+                "extra_sleep",
+            )
+        else:
+            self.wait_until_stable(sleep_time, "extra_sleep")
+
+    def wait_until(self, condition, timeout=None, reason="other"):
+        """
+        Poll condition() until it holds or timeout seconds (by default, wait_settings["timeout"]) have passed
+        :return: True if the condition holds
+        """
+        timeout = self.wait_settings["timeout"] if timeout is None else timeout
+        start = time.time()
+        while True:
+            try:
+                is_met = bool(condition())
+            except WebDriverException:
+                is_met = False
+            remaining = timeout - (time.time() - start)
+            if is_met or remaining <= 0:
+                break
+            time.sleep(min(self.wait_settings["interval"], remaining))
+        waits = self.waits[reason]
+        waits[0] += 1
+        waits[1] += time.time() - start
+        waits[2] += 0 if is_met else 1
+        return is_met
+
+    def wait_until_stable(self, timeout=None, reason="stable"):
+        """Wait until the UI hierarchy stops changing; :return: False on timeout"""
+        last = {"hash": None, "since": None}
+
+        def is_stable():
+            h, now = hash(self.fetch_page_source()), time.time()
+            if h != last["hash"]:
+                last["hash"], last["since"] = h, now
+                return False
+            return now - last["since"] >= self.wait_settings["stable_for"]
+
+        is_met = self.wait_until(is_stable, timeout, reason)
+        self.invalidate_screen()
+        return is_met
+
+    def has_element(self, locator):
+        """:param locator: e.g., {"resource-id": "org.wordpress.android:id/post_list"} or {"text": "Posts"}"""
+        if self.direct_source:  # match on a fresh hierarchy instead of find_elements
+            root = ScreenSnapshot(self.fetch_page_source()).root
+            if "resource-id" in locator:
+                rid = locator["resource-id"]
+                return bool(
+                    root.xpath(
+                        "//*[@resource-id=$rid or substring-after(@resource-id, ':id/')=$rid]",
+                        rid=rid,
+                    )
+                )
+            (attr, v), *_ = locator.items()
+            return bool(root.xpath(f"//*[@{attr}=$v]", v=v))
+        if "resource-id" in locator:
+            by, value = MobileBy.ID, locator["resource-id"]
+        else:
+            (attr, v), *_ = locator.items()
+            by, value = MobileBy.XPATH, f'//*[@{attr}="{v}"]'
+        self.driver.implicitly_wait(
+            0
+        )  # poll instead of waiting for the element to appear
+        try:
+            return bool(self.driver.find_elements(by, value))
+        finally:
+            self.driver.implicitly_wait(self.implicit_wait_default)
+
+    def wait_stats(self):
+        """:return: {reason: {"waits", "seconds", "timeouts"}}"""
+        return {
+            reason: {"waits": n, "seconds": round(seconds, 1), "timeouts": timeouts}
+            for reason, (n, seconds, timeouts) in self.waits.items()
+        }
 
     def run_system_input(self, event, driver_ele):
         special = {
@@ -209,20 +500,20 @@ class Runner:
             "node": "org.wordpress.android.ui.posts.EditPostActivity",
         }
         if all(event[k] == v for k, v in special.items()):
-            os.system(f'adb shell input text "{event["action_args"][0]}"')
+            self.adb(f"shell input text {AdbShell.quote_text(event['action_args'][0])}")
             return True
         elif event["action_args"][0] == "KEY_ENTER":
             if not self.driver.is_keyboard_shown():
                 txt = driver_ele.text
+                # each wait is bounded by the fixed sleeps (0.3s per step) it replaces
                 driver_ele.clear()
-                time.sleep(0.3)
+                self.wait_until(lambda: not driver_ele.text, 0.3, "input")
                 driver_ele.click()
-                time.sleep(0.3)
-                for c in txt:
-                    c = "\ " if c == " " else c
-                    os.system(f'adb shell input text "{c}"')
-                    time.sleep(0.3)
-            os.system("adb shell input keyevent 66")
+                self.wait_until(self.driver.is_keyboard_shown, 0.3, "input")
+                if txt:  # one `input text` instead of one adb process per character
+                    self.adb(f"shell input text {AdbShell.quote_text(txt)}")
+                self.wait_until(lambda: driver_ele.text == txt, 0.3 * len(txt), "input")
+            self.adb("shell input keyevent 66")
             return True
         return False
 
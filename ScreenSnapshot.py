@@ -0,0 +1,83 @@
+import lxml.etree
+from collections import defaultdict
+
+
+class ScreenSnapshot:
+    """
+    One fetched page_source and its lxml tree. The Runner hands out the same snapshot until it performs
+    an action, so every query on the current screen (WidgetUtil.retrieve_widgets, WidgetUtil.locate_widget
+    and the element checks of has_element) shares a single parse.
+    """
+
+    XML_PARSER = lxml.etree.XMLParser(recover=True, huge_tree=True)
+
+    def __init__(self, dom):
+        self.dom = dom
+        self._root = None
+        self._locators = None
+
+    @staticmethod
+    def parse_xml(dom):
+        # encode first: lxml rejects str input that carries an encoding declaration
+        return lxml.etree.fromstring(dom.encode("utf-8"), ScreenSnapshot.XML_PARSER)
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = ScreenSnapshot.parse_xml(self.dom)
+        return self._root
+
+    @property
+    def locators(self):
+        """
+        The values Runner.get_element_from_screen locates elements by, indexed in one pass over the hierarchy:
+        resource-id -> [(class, text, content-desc)], and the set of (class, attribute, value) for text,
+        content-desc and NAF; the tag of a node is its class
+        """
+        if self._locators is None:
+            by_id, by_attr = defaultdict(list), set()
+            for node in self.root.iter():
+                if not isinstance(
+                    node.tag, str
+                ):  # comments and processing instructions
+                    continue
+                attrib = node.attrib
+                text, desc = attrib.get("text", ""), attrib.get("content-desc", "")
+                rid = attrib.get("resource-id")
+                if rid:
+                    by_id[rid].append((node.tag, text, desc))
+                    short_id = rid.partition(":id/")[2]
+                    if (
+                        short_id
+                    ):  # find_elements(ID) also takes the id without "<package>:id/"
+                        by_id[short_id].append((node.tag, text, desc))
+                by_attr.add((node.tag, "text", text))
+                by_attr.add((node.tag, "content-desc", desc))
+                if attrib.get("NAF") == "true":
+                    by_attr.add((node.tag, "NAF", "true"))
+            self._locators = by_id, by_attr
+        return self._locators
+
+    def has_element(self, event):
+        """Whether Runner.get_element_from_screen would find an element for event on this screen, without a device call"""
+        by_id, by_attr = self.locators
+        clz = event.get("class")
+        if event.get("resource-id"):
+            if "id-prefix" in event and "/" not in event["resource-id"]:
+                rid = event["id-prefix"] + event["resource-id"]
+            else:
+                rid = event["resource-id"]
+            nodes = by_id.get(rid)
+            if not nodes:
+                return False
+            if len(nodes) > 1:
+                for i, attr in [(1, "text"), (2, "content-desc")]:
+                    if event.get(attr):
+                        return any(n[0] == clz and event[attr] in n[i] for n in nodes)
+            return True
+        for attr in ["text", "content-desc"]:
+            if event.get(attr):
+                return (clz, attr, event[attr]) in by_attr
+        if event.get("naf"):
+            return (clz, "NAF", "true") in by_attr
+        return False
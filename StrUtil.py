@@ -1,5 +1,6 @@
 import re
 import requests
+from collections import OrderedDict
 
 
 class StrUtil:
@@ -162,6 +163,8 @@ class StrUtil:
         "EDIT": "Edit",  # GitLab::TestEditIssue()
     }
 
+    NON_WORD_PATTERN = re.compile(r"[^\w]+")
+
     @staticmethod
     def camel_case_split(identifier):
         # https://stackoverflow.com/questions/29916065/how-to-do-camelcase-split-in-python
@@ -173,21 +176,39 @@ class StrUtil:
     @staticmethod
     def sanitize(s):
         s = s.strip()
-        s = re.sub(r"\s", " ", s)  # replace [ \t\n\r\f\v] with space
         # convert float with 0 fraction to int, e.g., 15.0 -> 15 (a54-a52-b51)
         try:
             if float(s) and float(s) == int(float(s)):
                 s = str(int(float(s)))
         except:
             pass
-        for k, v in StrUtil.TEXT_REPLACE.items():
-            s = s.replace(k, v)
-        s = re.sub(r"[^\w ]", " ", s)  # replace non [a-zA-Z0-9_], non-space with space
-        s = re.sub(r" +", " ", s)
+        s = StrUtil.TEXT_REPLACE_PATTERN.sub(
+            lambda m: StrUtil.TEXT_REPLACE_VALUES[m.lastindex - 1], s
+        )
+        s = StrUtil.NON_WORD_PATTERN.sub(" ", s)  # [^a-zA-Z0-9_] runs, incl. spaces
         return s.strip()
 
+    # (s_type, s, use_stopwords) -> tokens, least recently used first; widget and event strings never
+    # change during an exploration, but long runs see many of them, hence the bound
+    TOKEN_CACHE = OrderedDict()
+    TOKEN_CACHE_SIZE = 100000
+
     @staticmethod
     def tokenize(s_type, s, use_stopwords=True):
+        """Memoized tokenize_uncached; returns a new list on every call"""
+        key = (s_type, tuple(s) if isinstance(s, list) else s, use_stopwords)
+        tokens = StrUtil.TOKEN_CACHE.get(key)
+        if tokens is None:
+            tokens = tuple(StrUtil.tokenize_uncached(s_type, s, use_stopwords))
+            StrUtil.TOKEN_CACHE[key] = tokens
+            if len(StrUtil.TOKEN_CACHE) > StrUtil.TOKEN_CACHE_SIZE:
+                StrUtil.TOKEN_CACHE.popitem(last=False)
+        else:
+            StrUtil.TOKEN_CACHE.move_to_end(key)
+        return list(tokens)
+
+    @staticmethod
+    def tokenize_uncached(s_type, s, use_stopwords=True):
         if not s:
             return []
         res = []
@@ -229,36 +250,80 @@ class StrUtil:
 
     @staticmethod
     def merge_id(word_list):
-        for left, right, merged in StrUtil.MERGE:
-            if (
-                left in word_list
-                and right in word_list
-                and word_list.index(left) == word_list.index(right) - 1
-            ):
-                word_list = (
-                    word_list[: word_list.index(left)]
-                    + [merged]
-                    + word_list[word_list.index(right) + 1 :]
-                )
-        return word_list
+        """Merge every phrase of MERGE in word_list, left to right"""
+        res = []
+        i = 0
+        while i < len(word_list):
+            match = StrUtil.match_phrase(StrUtil.MERGE_TRIE, word_list, i)
+            if match:
+                merged, i = match
+                res.append(merged)
+            else:
+                res.append(word_list[i])
+                i += 1
+        return res
 
     @staticmethod
     def merge_text(word_list):
         """Only replace the beginning"""
-        for m in StrUtil.TEXT_MERGE:
-            if m[:-1] == word_list:
-                return m[-1:]
-        return word_list
+        merged = StrUtil.TEXT_MERGE_TABLE.get(tuple(word_list))
+        return [merged] if merged else word_list
 
     @staticmethod
     def merge_sibling_text(word_list):
         """Only replace the beginning"""
-        for m in StrUtil.SIBLING_TEXT_MERGE:
-            phrase_len = len(m) - 1
-            if m[:phrase_len] == word_list[:phrase_len]:
-                return [m[-1]] + word_list[phrase_len:]
+        match = StrUtil.match_phrase(StrUtil.SIBLING_TEXT_MERGE_TRIE, word_list, 0)
+        if match:
+            merged, end = match
+            return [merged] + word_list[end:]
         return word_list
 
+    @staticmethod
+    def build_trie(rules):
+        """
+        :param rules: [word, ..., merged]
+        :return: a word trie of the phrases, where the node of a phrase maps None to its merged word
+        """
+        trie = {}
+        for *phrase, merged in rules:
+            node = trie
+            for word in phrase:
+                node = node.setdefault(word, {})
+            node[None] = merged
+        return trie
+
+    @staticmethod
+    def match_phrase(trie, word_list, start):
+        """:return: (merged word, end index) of the longest phrase at word_list[start:], or None"""
+        match = None
+        node = trie
+        for i in range(start, len(word_list)):
+            node = node.get(word_list[i])
+            if node is None:
+                break
+            if None in node:
+                match = (node[None], i + 1)
+        return match
+
+    @classmethod
+    def compile_rules(cls):
+        """
+        Compile the rule tables above into the lookup structures used by tokenize, so that tokenizing
+        is linear in the input length however many rules there are.
+        Call it again after adding app-specific rules.
+        """
+        cls.MERGE_TRIE = cls.build_trie(cls.MERGE)
+        cls.TEXT_MERGE_TABLE = {tuple(m[:-1]): m[-1] for m in cls.TEXT_MERGE}
+        cls.SIBLING_TEXT_MERGE_TRIE = cls.build_trie(cls.SIBLING_TEXT_MERGE)
+        # all TEXT_REPLACE keys in one pass, longest first; a space in a key matches any whitespace
+        keys = sorted(cls.TEXT_REPLACE, key=len, reverse=True)
+        cls.TEXT_REPLACE_VALUES = [cls.TEXT_REPLACE[k] for k in keys]
+        cls.TEXT_REPLACE_PATTERN = re.compile(
+            "|".join("(" + re.escape(k).replace(r"\ ", r"\s") + ")" for k in keys)
+            or "(?!)"
+        )
+        cls.TOKEN_CACHE.clear()
+
     @staticmethod
     def rmv_stopwords(tokens):
         # global stopwords
@@ -318,3 +383,6 @@ class StrUtil:
     @staticmethod
     def is_contain_email(txt):
         return re.match(r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$", txt)
+
+
+StrUtil.compile_rules()
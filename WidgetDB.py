@@ -0,0 +1,142 @@
+from collections import defaultdict
+
+# local imports
+from WidgetUtil import WidgetUtil
+from LocalRanker import LocalRanker
+
+
+class WidgetDB:
+    """
+    The widget database (wDB) of an exploration: widgets keyed by WidgetUtil.get_signature,
+    with secondary indexes by node, class, clickability and static/dynamic origin.
+    Statically retrieved widgets (from ResourceParser) have no "clickable" attribute.
+    The token features of each widget (LocalRanker.widget_features) are computed once, the first time a
+    local ranker asks for them (features_of). They hold ids of the process-wide LocalRanker.TOKEN_IDS, so
+    they are not pickled; a loaded wDB computes them again in its own process.
+    """
+
+    STATIC_KEYS = WidgetUtil.FEATURE_KEYS[:4] + ["package", "node"]
+
+    def __init__(self, widgets=(), use_stopwords=True):
+        self.use_stopwords = use_stopwords
+        self.widgets = {}  # signature -> widget, in insertion order
+        self.features = (
+            {}
+        )  # signature -> LocalRanker.widget_features, filled by features_of
+        self.order = {}  # signature -> insertion sequence number
+        self.next_order = 0
+        # the indexes map a key to an insertion-ordered {signature: None}
+        self.by_node = defaultdict(dict)
+        self.by_class = defaultdict(dict)
+        self.clickables = {}
+        self.menu_items = {}
+        self.dynamic = {}
+        self.static = {}  # static key -> signature
+        for w in widgets:
+            self.add(w)
+
+    @classmethod
+    def static_key(cls, w):
+        """The attributes a dynamic widget shares with its statically retrieved counterpart"""
+        return tuple(w.get(k, "") for k in cls.STATIC_KEYS)
+
+    @staticmethod
+    def is_static(w):
+        return "clickable" not in w
+
+    def add(self, w):
+        """:return: True if w is new to the wDB"""
+        signature = WidgetUtil.get_signature(w)
+        if signature in self.widgets:
+            return False
+        self.widgets[signature] = w
+        self.order[signature] = self.next_order
+        self.next_order += 1
+        self.by_node[w.get("node", "")][signature] = None
+        self.by_class[w.get("class", "")][signature] = None
+        if w.get("clickable", "") == "true":
+            self.clickables[signature] = None
+        if "menu_group" in w:
+            self.menu_items[signature] = None
+        if WidgetDB.is_static(w):
+            self.static[WidgetDB.static_key(w)] = signature
+        else:
+            self.dynamic[signature] = None
+        return True
+
+    def pop(self, signature, default=None):
+        w = self.widgets.pop(signature, None)
+        if w is None:
+            return default
+        del self.order[signature]
+        self.features.pop(signature, None)
+        self.by_node[w.get("node", "")].pop(signature, None)
+        self.by_class[w.get("class", "")].pop(signature, None)
+        self.clickables.pop(signature, None)
+        self.menu_items.pop(signature, None)
+        self.dynamic.pop(signature, None)
+        if WidgetDB.is_static(w):
+            self.static.pop(WidgetDB.static_key(w), None)
+        return w
+
+    def pop_static(self, w):
+        """Remove the statically retrieved counterpart of a dynamically discovered widget w, if any"""
+        signature = self.static.get(WidgetDB.static_key(w))
+        return self.pop(signature) if signature else None
+
+    def select(self, classes=(), clickable=False, menu=False, node=None):
+        """
+        Widgets of any of the classes, or clickable (if set), or menu items (if set), in insertion order.
+        If node is given, only widgets of that node are returned; with no other criteria, all of them.
+        """
+        if classes or clickable or menu:
+            signatures = set()
+            for clz in classes:
+                signatures.update(self.by_class.get(clz, ()))
+            if clickable:
+                signatures.update(self.clickables)
+            if menu:
+                signatures.update(self.menu_items)
+            if node is not None:
+                signatures.intersection_update(self.by_node.get(node, ()))
+            return [
+                self.widgets[s] for s in sorted(signatures, key=self.order.__getitem__)
+            ]
+        if node is not None:
+            return [self.widgets[s] for s in self.by_node.get(node, ())]
+        return list(self.widgets.values())
+
+    def features_of(self, widgets, use_stopwords=True):
+        """The token features of widgets, computed once per widget; None if use_stopwords differs from the wDB's"""
+        if use_stopwords != self.use_stopwords:
+            return None
+        features = []
+        for w in widgets:
+            signature = WidgetUtil.get_signature(w)
+            if signature not in self.features:
+                self.features[signature] = LocalRanker.widget_features(
+                    w, self.use_stopwords
+                )
+            features.append(self.features[signature])
+        return features
+
+    def __getstate__(self):
+        # token ids are only valid in the process that interned them
+        state = self.__dict__.copy()
+        state["features"] = {}
+        return state
+
+    def get(self, signature, default=None):
+        return self.widgets.get(signature, default)
+
+    def values(self):
+        return self.widgets.values()
+
+    def __contains__(self, signature):
+        return signature in self.widgets
+
+    def __iter__(self):
+        return iter(self.widgets)
+
+    def __len__(self):
+        return len(self.widgets)
@@ -1,4 +1,6 @@
 import json
+import time
+import lxml.etree
 from bs4 import BeautifulSoup, NavigableString
 import re
 
@@ -7,7 +9,9 @@ import requests
 # local imports
 from EventAction import EventAction
 from StrUtil import StrUtil
+from LocalRanker import LocalRanker
 from logger import logger
+from ScreenSnapshot import ScreenSnapshot
 import os
 
 os.environ["NO_PROXY"] = "127.0.0.1"
@@ -36,8 +40,44 @@ class WidgetUtil:
         "androidx.appcompat.app.ActionBar.Tab",
         "android.widget.CheckedTextView",
     ]
+    # class chains from the parent upwards; a non-clickable widget is clickable if the last ancestor is
+    CLICKABLE_ANCESTORS = [
+        # "HTML Mode" in WP::TestAddDraft()
+        [
+            "android.widget.RelativeLayout",
+            "android.widget.LinearLayout",
+            "android.widget.LinearLayout",
+        ],
+        # "Customer Service" in Groupon::TestCustomerSupport()
+        [
+            "android.widget.LinearLayout",
+            "android.widget.RelativeLayout",
+            "android.widget.FrameLayout",
+        ],
+        # Quantity text in Groupon::TestRemoveFromCart()
+        ["android.widget.FrameLayout", "android.widget.FrameLayout"],
+        # file_list_size in OwnCloud::TestCreateLink()
+        ["android.view.ViewGroup", "android.view.ViewGroup"],
+        # photo_view in OwnCloud::TestFileDetail()
+        ["android.widget.RelativeLayout", "androidx.viewpager.widget.ViewPager"],
+        # project_title in GitLab::TestProjDetail()
+        ["android.widget.LinearLayout", "android.widget.LinearLayout"],
+        # TextView in HackerNews::TestAskSection()
+        [
+            "android.widget.LinearLayout",
+            "android.widget.LinearLayout",
+            "android.widget.FrameLayout",
+        ],
+    ]
     SIGNATURE_SPLIT = "!"
+    EQUALITY_KEYS = [k for k in FEATURE_KEYS if k != "naf"] + ["node"]
     SUPPORTED_ACTIONS = {a.value for a in EventAction}
+    RANKING_URL = "http://127.0.0.1:8000/api/get_candidates"
+    BATCH_RANKING_URL = "http://127.0.0.1:8000/api/get_candidates_batch"
+    # signatures of the candidates already uploaded to the BenGPT service for batch ranking, valid for
+    # the service session (ranking_session) that received them; a restarted service starts a new one
+    uploaded_signatures = set()
+    ranking_session = None
 
     @classmethod
     def get_signature(cls, w):
@@ -45,6 +85,20 @@ class WidgetUtil:
         attrs = cls.FEATURE_KEYS + ["package", "node"]
         return cls.SIGNATURE_SPLIT.join([w[a] if a in w else "" for a in attrs])
 
+    @staticmethod
+    def get_root(dom):
+        """dom is either a raw page_source or a ScreenSnapshot that caches its parsed tree"""
+        if isinstance(dom, ScreenSnapshot):
+            return dom.root
+        return ScreenSnapshot.parse_xml(dom)
+
+    @staticmethod
+    def get_soup(dom):
+        """A BeautifulSoup tree of dom, for the reference implementation retrieve_widgets_from_soup only"""
+        if isinstance(dom, ScreenSnapshot):
+            dom = dom.dom
+        return BeautifulSoup(dom, "lxml")
+
     @classmethod
     def retrieve_widgets(cls, pkg, act, dom):
         if "com.android.launcher" in pkg:  # the app is closed
@@ -53,7 +107,35 @@ class WidgetUtil:
             "com.facebook"
         ):  # the app reaches facebook login, out of the app"s scope
             return []
-        soup = BeautifulSoup(dom, "lxml")
+        # one walk over the hierarchy; the stack holds (class, clickable, text) of the enclosing elements
+        buckets = {w_class: [] for w_class in cls.WIDGET_CLASSES}
+        ancestors = []
+        for event, e in lxml.etree.iterwalk(cls.get_root(dom), events=("start", "end")):
+            if not isinstance(e.tag, str):  # comments and processing instructions
+                continue
+            if event == "end":
+                ancestors.pop()
+                continue
+            clz = e.get("class")
+            if clz in buckets:
+                w = cls.get_widget_from_xml_element(e, ancestors)
+                if w:
+                    w["package"], w["node"] = pkg, act
+                    buckets[clz].append(w)
+            ancestors.append((clz, e.get("clickable") == "true", e.get("text", "")))
+        # same order as retrieve_widgets_from_soup: by WIDGET_CLASSES, then document order
+        return [w for w_class in cls.WIDGET_CLASSES for w in buckets[w_class]]
+
+    @classmethod
+    def retrieve_widgets_from_soup(cls, pkg, act, dom):
+        """The BeautifulSoup reference implementation of retrieve_widgets"""
+        if "com.android.launcher" in pkg:  # the app is closed
+            return []
+        if act.startswith(
+            "com.facebook"
+        ):  # the app reaches facebook login, out of the app"s scope
+            return []
+        soup = cls.get_soup(dom)
         widgets = []
         for w_class in cls.WIDGET_CLASSES:
             elements = soup.find_all(attrs={"class": w_class})
@@ -64,6 +146,67 @@ class WidgetUtil:
                     widgets.append(w)
         return widgets
 
+    @classmethod
+    def get_widget_from_xml_element(cls, e, ancestors):
+        """Same widget dict as get_widget_from_soup_element, with ancestors taken from the walk stack"""
+        attrib = e.attrib
+        if attrib.get("enabled") != "true":
+            return None
+        # no FrameLayout filter here: in the soup path e.attrs["class"] is a list and never equals the
+        # class string, so enabled FrameLayouts are always kept
+        w = {}
+        for key in cls.FEATURE_KEYS:
+            if (
+                key == "naf"
+            ):  # UI Automator reports "NAF"; the HTML parser of bs4 lowercases it
+                w[key] = attrib.get("NAF", attrib.get("naf", ""))
+            else:
+                w[key] = attrib.get(key, "")
+            if key == "clickable" and w[key] == "false":
+                w[key] = cls.is_ancestor_stack_clickable(ancestors)
+            elif key == "resource-id":
+                rid = w[key].split("/")[-1]
+                prefix = "".join(w[key].split("/")[:-1])
+                w[key] = rid
+                w["id-prefix"] = prefix + "/" if prefix else ""
+        w["parent_text"] = ancestors[-1][2] if ancestors else ""
+        w["sibling_text"] = ""
+        if (
+            w["class"] == "android.widget.ImageButton"
+            and ancestors
+            and ancestors[-1][0] == "android.widget.LinearLayout"
+        ):
+            siblings = [sb for sb in e.itersiblings() if isinstance(sb.tag, str)]
+            if (
+                len(siblings) == 1
+                and siblings[0].get("class") == "android.widget.TextView"
+            ):
+                w["sibling_text"] = siblings[0].get("text", "")
+        return w
+
+    @classmethod
+    def is_ancestor_stack_clickable(cls, ancestors):
+        """is_parent_clickable over the (class, clickable, text) stack of retrieve_widgets"""
+        if not ancestors:
+            return "false"
+        if ancestors[-1][1]:
+            return "true"
+        for pattern in cls.CLICKABLE_ANCESTORS:
+            if len(pattern) > len(ancestors):
+                continue
+            for i, clz in enumerate(pattern):
+                a_clz, a_clickable, _ = ancestors[-1 - i]
+                if a_clz != clz:
+                    break
+                if i == len(pattern) - 1 and (
+                    a_clickable or clz == "androidx.viewpager.widget.ViewPager"
+                ):
+                    return "true"
+        for a_clz, a_clickable, _ in ancestors[-3:-1]:  # a22-a23-b22
+            if a_clz == "android.widget.ListView" and a_clickable:
+                return "true"
+        return "false"
+
     @classmethod
     def get_widget_from_soup_element(cls, e):
         if not e or ("enabled" not in e.attrs) or (e["enabled"] != "true"):
@@ -95,55 +238,9 @@ class WidgetUtil:
         if parent and "clickable" in parent.attrs and parent["clickable"] == "true":
             return "true"
 
-        # "HTML Mode" in WP::TestAddDraft()
-        ancestors = [
-            "android.widget.RelativeLayout",
-            "android.widget.LinearLayout",
-            "android.widget.LinearLayout",
-        ]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
-
-        # "Customer Service" in Groupon::TestCustomerSupport()
-        ancestors = [
-            "android.widget.LinearLayout",
-            "android.widget.RelativeLayout",
-            "android.widget.FrameLayout",
-        ]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
-
-        # Quantity text in Groupon::TestRemoveFromCart()
-        ancestors = ["android.widget.FrameLayout", "android.widget.FrameLayout"]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
-
-        # file_list_size in OwnCloud::TestCreateLink()
-        ancestors = ["android.view.ViewGroup", "android.view.ViewGroup"]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
-
-        # photo_view in OwnCloud::TestFileDetail()
-        ancestors = [
-            "android.widget.RelativeLayout",
-            "androidx.viewpager.widget.ViewPager",
-        ]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
-
-        # project_title in GitLab::TestProjDetail()
-        ancestors = ["android.widget.LinearLayout", "android.widget.LinearLayout"]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
-
-        # TextView in HackerNews::TestAskSection()
-        ancestors = [
-            "android.widget.LinearLayout",
-            "android.widget.LinearLayout",
-            "android.widget.FrameLayout",
-        ]
-        if WidgetUtil.is_ancestor_clickable(parent, ancestors):
-            return "true"
+        for ancestors in cls.CLICKABLE_ANCESTORS:
+            if WidgetUtil.is_ancestor_clickable(parent, ancestors):
+                return "true"
 
         parent = soup_element.find_parent()  # a22-a23-b22
         for i in range(2):
@@ -201,38 +298,29 @@ class WidgetUtil:
         return ""
 
     @classmethod
-    def sort(
-        cls, src_event, widgets, use_stopwords=True, expand_btn_to_text=False, top=12
-    ):
+    def candidate_query(cls, src_event):
+        """The widgets to consider for src_event, as keyword arguments of WidgetDB.select"""
         # todo: also refer to src_class (src_event['class']) to determine candidate widgets if necessary
-        candidates = []
         src_action = src_event["action"]
         if src_action not in cls.SUPPORTED_ACTIONS:
             assert False, "Unsupported Action"
         if src_action == EventAction.CLICK.value:
             # if (dynamically discovered and clickable) or (static and (some classes or menu nodes))
-            candidates += [
-                w
-                for w in widgets
-                if ("clickable" in w and w["clickable"] == "true")
-                or w["class"] in {"android.widget.ImageButton", "android.widget.Button"}
-                or "menu_group" in w
-            ]
+            return {
+                "classes": {"android.widget.ImageButton", "android.widget.Button"},
+                "clickable": True,
+                "menu": True,
+            }
         elif src_action == EventAction.TEXT_PRESENT.value:
-            candidates += [
-                w
-                for w in widgets
-                if w["class"]
-                in {
+            return {
+                "classes": {
                     "android.widget.TextView",
                     "android.view.View",
                     "android.widget.CheckedTextView",
                 }
-            ]
+            }
         elif src_action in {EventAction.SEND_KEYS.value, EventAction.CLEAR.value}:
-            candidates += [
-                w for w in widgets if w["class"] in {"android.widget.EditText"}
-            ]
+            return {"classes": {"android.widget.EditText"}}
         elif src_action in {
             EventAction.IS_DISPLAYED.value,
             EventAction.IS_ATTR_EQUAL.value,
@@ -244,18 +332,118 @@ class WidgetUtil:
             }
             if src_event["tag"].lower() == "button":
                 classes.add("android.widget.Button")
-            candidates += [w for w in widgets if w["class"] in classes]
+            return {"classes": classes}
         else:
             assert False, "Unsupported Action"
+
+    @classmethod
+    def filter_candidates(cls, src_event, widgets):
+        """widgets is either an indexed WidgetDB or any iterable of widgets"""
+        query = cls.candidate_query(src_event)
+        if hasattr(widgets, "select"):  # WidgetDB
+            return widgets.select(**query)
+        return [
+            w
+            for w in widgets
+            if w["class"] in query["classes"]
+            or (query.get("clickable") and w.get("clickable", "") == "true")
+            or (query.get("menu") and "menu_group" in w)
+        ]
+
+    @classmethod
+    def sort(
+        cls,
+        src_event,
+        widgets,
+        use_stopwords=True,
+        expand_btn_to_text=False,
+        top=12,
+        ranker="llm",
+        rerank_top_k=5,
+        cache=None,
+    ):
+        """
+        :param ranker: "llm" (BenGPT service), "local" (LocalRanker) or "local+llm" (LocalRanker,
+        then BenGPT re-ranks its top rerank_top_k)
+        :param cache: an optional RankCache for the rankings
+        :return: [(widget, sim_score)], best first
+        """
+        candidates = cls.filter_candidates(src_event, widgets)
         logger.info(f"{len(candidates)} candidate widgets to sort...")
+        if not candidates:
+            return []
+        options = [ranker, use_stopwords, expand_btn_to_text, top, rerank_top_k]
+        features = (
+            widgets.features_of(candidates, use_stopwords)
+            if ranker != "llm" and hasattr(widgets, "features_of")
+            else None
+        )
+        if not cache:
+            return cls.rank(src_event, candidates, *options, features=features)
 
-        data = {"src_event": src_event, "candidates": candidates}
+        # a ranking holds only for the candidate set it was made from: scores of separate calls to the
+        # BenGPT service are not comparable, so a changed set is ranked again as a whole
+        by_signature = {cls.get_signature(w): w for w in candidates}
+        key = cache.key(options, src_event, list(by_signature))
+        ranking = cache.get(key)
+        if ranking is not None:
+            logger.info("Ranking found in cache")
+            return [
+                (by_signature[sig], score)
+                for sig, score in ranking
+                if sig in by_signature
+            ]
+        candidate_tuples = cls.rank(src_event, candidates, *options, features=features)
+        cache.put(key, [[cls.get_signature(w), score] for w, score in candidate_tuples])
+        return candidate_tuples
 
-        resp = requests.post(
-            url="http://127.0.0.1:8000/api/get_candidates",
-            json=data,
-            headers={"User-Agent": "Mozilla/5.0", "Content-Type": "application/json"},
+    @classmethod
+    def rank(
+        cls,
+        src_event,
+        candidates,
+        ranker="llm",
+        use_stopwords=True,
+        expand_btn_to_text=False,
+        top=12,
+        rerank_top_k=5,
+        features=None,
+    ):
+        """:param features: precomputed LocalRanker.widget_features of the candidates, if any"""
+        if ranker == "llm":
+            return cls.rank_remote(src_event, candidates)
+        candidate_tuples = LocalRanker.rank(
+            src_event, candidates, use_stopwords, expand_btn_to_text, top, features
         )
+        if ranker == "local+llm" and candidate_tuples:
+            candidate_tuples = cls.rerank_remote(
+                src_event, candidate_tuples, rerank_top_k
+            )
+        return candidate_tuples
+
+    @staticmethod
+    def post_ranking(url, data, retries=5):
+        """POST to the BenGPT service, retrying while it sheds load (503)"""
+        for _ in range(retries):
+            resp = requests.post(
+                url=url,
+                json=data,
+                headers={
+                    "User-Agent": "Mozilla/5.0",
+                    "Content-Type": "application/json",
+                },
+            )
+            if resp.status_code != 503:
+                break
+            time.sleep(float(resp.headers.get("Retry-After", 1)))
+        return resp
+
+    @classmethod
+    def rank_remote(cls, src_event, candidates):
+        """Rank the candidates with the BenGPT service (BenGPT/API.py)"""
+        data = {"src_event": src_event, "candidates": candidates}
+
+        resp = cls.post_ranking(cls.RANKING_URL, data)
         candidates = json.loads(resp.json()["result"])
 
         candidate_tuples = [
@@ -264,6 +452,145 @@ class WidgetUtil:
 
         return candidate_tuples
 
+    @classmethod
+    def rerank_remote(cls, src_event, candidate_tuples, top_k):
+        """
+        Re-rank the top_k of locally ranked candidates with the BenGPT service: those it ranks come first, in
+        its order, then those it leaves out, in their local order, then the rest. The local scores of the
+        top_k are handed out in the new order, so that all scores stay on the local scale and the rest ranks
+        below the re-ranked top_k
+        """
+        top = candidate_tuples[:top_k]
+        by_signature = {cls.get_signature(w): w for w, _ in top}
+        ranked = []  # [(widget, score of the service)]
+        for w, score in cls.rank_remote(src_event, [w for w, _ in top]):
+            w = by_signature.pop(cls.get_signature(w), None)
+            if w is not None:
+                ranked.append((w, score))
+        omitted = [w for w, _ in top if cls.get_signature(w) in by_signature]
+        local_scores = sorted((score for _, score in top), reverse=True)
+        reranked = []
+        for i, (w, score) in enumerate(ranked):
+            if i and score == ranked[i - 1][1]:  # keep the ties of the service
+                reranked.append((w, reranked[-1][1]))
+            else:
+                reranked.append((w, local_scores[i]))
+        reranked += [(w, local_scores[len(ranked) + i]) for i, w in enumerate(omitted)]
+        return reranked + candidate_tuples[top_k:]
+
+    @classmethod
+    def prefetch(
+        cls,
+        src_events,
+        widgets,
+        use_stopwords=True,
+        expand_btn_to_text=False,
+        top=12,
+        ranker="llm",
+        rerank_top_k=5,
+        cache=None,
+    ):
+        """
+        Rank the src_events against widgets with one batch call to the BenGPT service and cache the
+        rankings, so that sort() finds them there. Events whose candidate set already has a cached ranking
+        are left out; the others are ranked against all their candidates, of which only the ones the
+        service has not received yet (e.g., widgets added to the wDB since) are uploaded.
+        """
+        if ranker != "llm" or not cache:
+            return
+        options = [ranker, use_stopwords, expand_btn_to_text, top, rerank_top_k]
+        pending, table = [], {}  # pending: [(key, src_event, signatures)]
+        for src_event in src_events:
+            candidates = cls.filter_candidates(src_event, widgets)
+            if not candidates:
+                continue
+            by_signature = {cls.get_signature(w): w for w in candidates}
+            key = cache.key(options, src_event, list(by_signature))
+            if key in cache:
+                continue
+            table.update(by_signature)
+            pending.append((key, src_event, list(by_signature)))
+        if not pending:
+            return
+        logger.info(f"Prefetching the rankings of {len(pending)} src events")
+        try:
+            rankings = cls.rank_remote_batch(
+                [src_event for _, src_event, _ in pending],
+                [signatures for _, _, signatures in pending],
+                table,
+            )
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logger.info(f"Prefetching failed, rank one by one instead: {e}")
+            return
+        for (key, _, _), ranking in zip(pending, rankings):
+            cache.put(key, ranking)
+
+    @classmethod
+    def rank_remote_batch(cls, src_events, signature_lists, table):
+        """
+        Rank the candidates of many src_events with one call to the BenGPT service. Candidates are
+        uploaded once and then referred to by their signatures.
+
+        :param signature_lists: for each src_event, the signatures of its candidates
+        :param table: signature -> widget, for all signatures in signature_lists
+        :return: for each src_event, [[signature, sim_score]], best first
+        """
+        signatures = {sig for sigs in signature_lists for sig in sigs}
+        data = {
+            "table": {
+                sig: table[sig]
+                for sig in signatures
+                if sig not in cls.uploaded_signatures
+            },
+            "requests": [
+                {"src_event": src_event, "candidates": sigs}
+                for src_event, sigs in zip(src_events, signature_lists)
+            ],
+        }
+        try:
+            resp = cls.post_ranking(cls.BATCH_RANKING_URL, data)
+            cls.check_ranking_session(resp)
+            if (
+                resp.status_code == 409
+            ):  # e.g., the service restarted and lost the table
+                data["table"] = {sig: table[sig] for sig in signatures}
+                resp = cls.post_ranking(cls.BATCH_RANKING_URL, data)
+                cls.check_ranking_session(resp)
+            resp.raise_for_status()
+            results = resp.json()["results"]
+        except (requests.RequestException, KeyError, ValueError):
+            # the service may not hold the uploaded candidates anymore; upload them again next time
+            cls.uploaded_signatures.clear()
+            raise
+        cls.uploaded_signatures.update(signatures)
+        return [
+            [[r["signature"], r["sim_score"]] for r in ranking] for ranking in results
+        ]
+
+    @classmethod
+    def check_ranking_session(cls, resp):
+        """Forget the uploaded signatures if resp comes from another session of the service than they went to"""
+        try:
+            session = resp.json().get("session")
+        except ValueError:
+            return
+        if session != cls.ranking_session:
+            cls.uploaded_signatures.clear()
+            cls.ranking_session = session
+
+    @classmethod
+    def equality_key(cls, w):
+        """Hashable key of w such that is_equal(w1, w2) iff their keys are equal (for non-empty w1, w2)"""
+        key = []
+        for k in cls.EQUALITY_KEYS:
+            if k not in w:
+                key.append((k, None))
+            elif k == "resource-id" and "id-prefix" in w:
+                key.append((k, w["id-prefix"] + w[k]))
+            else:
+                key.append((k, w[k]))
+        return tuple(key)
+
     @classmethod
     def is_equal(cls, w1, w2):
         if not w1 or not w2:
@@ -289,7 +616,7 @@ class WidgetUtil:
     @classmethod
     def locate_widget(cls, dom, e_type, locators):
         # refer to NavGraph for legitimate e_types and locator_types
-        soup = BeautifulSoup(dom, "lxml")
+        root = cls.get_root(dom)
         if e_type == "GUI":
             attrs = dict()
             for l_type, l_value in locators.items():
@@ -299,8 +626,22 @@ class WidgetUtil:
                 l_value = l_value.replace("+", "\+")
                 v = re.compile(l_value)
                 attrs[k] = v
-            ele = soup.find(attrs=attrs)
-            return cls.get_widget_from_soup_element(ele) if ele else None
+            # the first element in document order whose attributes all match, as BeautifulSoup.find(attrs=attrs)
+            for e in root.iter(tag=lxml.etree.Element):
+                if all(
+                    e.get(k) is not None and v.search(e.get(k))
+                    for k, v in attrs.items()
+                ):
+                    ancestors = [
+                        (
+                            a.get("class"),
+                            a.get("clickable") == "true",
+                            a.get("text", ""),
+                        )
+                        for a in reversed(list(e.iterancestors()))
+                    ]
+                    return cls.get_widget_from_xml_element(e, ancestors)
+            return None
         elif e_type == "OPTION_MENU":
             assert False, "to be implemented"
         assert False, "to be implemented"
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# local imports
+from EventAction import EventAction
+from ExplorerUtil import ExplorerUtil
+from LocalRanker import LocalRanker
+from ResourceParser import ResourceParser
+from WidgetDB import WidgetDB
+from WidgetUtil import WidgetUtil
+
+
+if __name__ == "__main__":
+    # Benchmark tokenization and ranking over the widgets of an app, e.g.,
+    # python bench/bench_local_ranker.py config/owncloud/config.json aug_TestSearchDetail
+    config = ExplorerUtil.load_config(sys.argv[1], sys.argv[2])
+    widgets = ResourceParser(
+        config["resource_path"], config["model_path"]
+    ).get_widgets()
+    src_events = ExplorerUtil.load_events(
+        config["web_test_path"].replace(".py", ".json")
+    )
+    print(f"{len(widgets)} widgets, {len(src_events)} src events")
+
+    for label in ["cold", "memoized"]:
+        start = time.perf_counter()
+        for w in widgets:
+            LocalRanker.widget_features(w, config["use_stopwords"])
+        print(f"tokenize ({label}): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    db = WidgetDB(widgets, config["use_stopwords"])
+    db.features_of(db.values(), config["use_stopwords"])
+    print(
+        f"WidgetDB insertion and features: {(time.perf_counter() - start) * 1000:.1f} ms"
+    )
+    for label, precomputed in [("tokenized per call", False), ("precomputed", True)]:
+        start = time.perf_counter()
+        for e in src_events:
+            if e["action"] in {
+                EventAction.TEXT_NOT_PRESENT.value,
+                EventAction.MOUSEOVER.value,
+                EventAction.JUMP_WITH_URL.value,
+            }:
+                continue
+            candidates = WidgetUtil.filter_candidates(e, db)
+            LocalRanker.rank(
+                e,
+                candidates,
+                config["use_stopwords"],
+                features=db.features_of(candidates, config["use_stopwords"])
+                if precomputed
+                else None,
+            )
+        print(f"rank ({label}): {(time.perf_counter() - start) * 1000:.1f} ms")
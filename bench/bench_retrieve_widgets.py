@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import XMLParsedAsHTMLWarning
+
+# local imports
+from WidgetUtil import WidgetUtil
+
+warnings.simplefilter("ignore", XMLParsedAsHTMLWarning)
+
+
+if __name__ == "__main__":
+    # Time retrieve_widgets against the soup reference implementation on page_source dumps,
+    # e.g., python bench/bench_retrieve_widgets.py tests/dumps/*.xml
+    for dump_path in sys.argv[1:]:
+        with open(dump_path, "r", encoding="utf-8") as f:
+            dump = f.read()
+        timings = {}
+        for name, fn in [
+            ("soup", WidgetUtil.retrieve_widgets_from_soup),
+            ("lxml", WidgetUtil.retrieve_widgets),
+        ]:
+            start = time.perf_counter()
+            for _ in range(20):
+                widgets = fn("pkg", "act", dump)
+            timings[name] = (time.perf_counter() - start) / 20 * 1000
+        print(
+            f"{dump_path}: {len(widgets)} widgets, "
+            f"soup {timings['soup']:.1f} ms, lxml {timings['lxml']:.1f} ms"
+        )
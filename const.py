@@ -4,3 +4,4 @@ CONFIG_FOLDER = "config"
 AUG_PREFIX = "aug_"
 SNAPSHOT_FOLDER = "snapshot"
 EMPTY_CLASS = "EMPTY"
+CACHE_FOLDER = "cache"
@@ -1,23 +1,138 @@
 # Run this script on the owncloud host machine with sudo
 
 from flask import Flask
-from flask_restful import Api, Resource, reqparse
+from flask_restful import Api, Resource
+from xml.etree import ElementTree
+from urllib.parse import quote, unquote
+from collections import defaultdict
+import threading
+import requests
 import os
+import re
 import time
 
+OC_URL = os.getenv("OC_URL", "http://localhost:8080")
+ADMIN = (os.getenv("ADMIN_USERNAME", "sealbot"), os.getenv("ADMIN_PASSWORD", "anteater"))
+TENANT_PASSWORD = os.getenv("TENANT_PASSWORD", ADMIN[1])
+# the files every tenant starts with, e.g., snapshot/Documents/example.odt
+SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot")
+DAV_NS = "{DAV:}"
+OCS_HEADERS = {"OCS-APIRequest": "true"}
+
+tenant_locks = defaultdict(threading.Lock)  # resets of different tenants run in parallel
+
+
+def wait_until_ready(timeout=180):
+    """Poll status.php until ownCloud is installed and out of maintenance mode"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            status = requests.get(f"{OC_URL}/status.php", timeout=2).json()
+            if status.get("installed") and not status.get("maintenance"):
+                return True
+        except (requests.RequestException, ValueError):
+            pass
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.5)
+
+
+def tenant_account(tenant):
+    """The "default" tenant is the admin account, the other tenants have a user each"""
+    if tenant == "default":
+        return ADMIN
+    return tenant, TENANT_PASSWORD
+
+
+def ensure_user(user, password):
+    if (user, password) == ADMIN:
+        return
+    requests.post(  # statuscode 102 (user exists) is fine
+        f"{OC_URL}/ocs/v1.php/cloud/users",
+        data={"userid": user, "password": password},
+        headers=OCS_HEADERS,
+        auth=ADMIN,
+    )
+
+
+def reset_tenant(tenant):
+    """Restore the files of the tenant to SNAPSHOT and remove its shares and trash"""
+    user, password = tenant_account(tenant)
+    auth = (user, password)
+    ensure_user(user, password)
+    root = f"/remote.php/dav/files/{quote(user)}/"
+
+    # shares (e.g., public links created by a test)
+    shares = requests.get(
+        f"{OC_URL}/ocs/v1.php/apps/files_sharing/api/v1/shares?format=json",
+        headers=OCS_HEADERS,
+        auth=auth,
+    ).json()["ocs"]["data"]
+    for share in shares:
+        requests.delete(
+            f"{OC_URL}/ocs/v1.php/apps/files_sharing/api/v1/shares/{share['id']}",
+            headers=OCS_HEADERS,
+            auth=auth,
+        )
+
+    # files
+    listing = requests.request(
+        "PROPFIND", OC_URL + root, headers={"Depth": "1"}, auth=auth
+    )
+    listing.raise_for_status()
+    for response in ElementTree.fromstring(listing.content).iter(DAV_NS + "response"):
+        href = response.find(DAV_NS + "href").text
+        if unquote(href).rstrip("/") != unquote(root).rstrip("/"):
+            requests.delete(OC_URL + href, auth=auth)
+    requests.delete(f"{OC_URL}/remote.php/dav/trash-bin/{quote(user)}/", auth=auth)
+    for folder, dirs, files in os.walk(SNAPSHOT):
+        rel = os.path.relpath(folder, SNAPSHOT)
+        prefix = "" if rel == "." else quote(rel.replace(os.sep, "/")) + "/"
+        for d in dirs:
+            requests.request("MKCOL", f"{OC_URL}{root}{prefix}{quote(d)}", auth=auth)
+        for name in files:
+            with open(os.path.join(folder, name), "rb") as f:
+                requests.put(f"{OC_URL}{root}{prefix}{quote(name)}", data=f, auth=auth)
+
 
 class OwnCloudReset(Resource):
     def get(self):
+        """Recreate the whole server (all tenants) from empty volumes"""
         os.system("docker-compose down")
         # os.system("docker rm -f $(docker ps -a -q)")
         os.system("docker volume rm $(docker volume ls -q)")
         os.system("docker-compose up -d")
-        time.sleep(15)
+        if not wait_until_ready():
+            return {"error": "ownCloud is not ready"}, 503
         return {}, 200
 
 
+class OwnCloudTenantReset(Resource):
+    def get(self, tenant):
+        """Reset the data of one tenant (e.g., the device of an Explorer worker) only"""
+        if not re.fullmatch(r"[A-Za-z0-9_.@-]+", tenant):  # refer to ExplorerUtil.tenant_name
+            return {"error": f"invalid ownCloud user name: {tenant}"}, 400
+        if not wait_until_ready(timeout=10):
+            return {"error": "ownCloud is not ready"}, 503
+        start = time.time()
+        with tenant_locks[tenant]:
+            reset_tenant(tenant)
+        return {"tenant": tenant, "seconds": round(time.time() - start, 3)}, 200
+
+
+class OwnCloudReady(Resource):
+    def get(self):
+        if wait_until_ready(timeout=0):
+            return {"ready": True}, 200
+        return {"ready": False}, 503
+
+
 if __name__ == '__main__':
+    if not os.path.exists(SNAPSHOT):  # the files of a fresh account
+        os.system(f"docker cp owncloud_server:/var/www/owncloud/core/skeleton {SNAPSHOT}")
     app = Flask(__name__)
     api = Api(app)
     api.add_resource(OwnCloudReset, '/owncloud-reset')
-    app.run(debug=True, host="0.0.0.0")
+    api.add_resource(OwnCloudTenantReset, '/owncloud-reset/<string:tenant>')
+    api.add_resource(OwnCloudReady, '/ready')
+    app.run(debug=True, host="0.0.0.0", threaded=True)
@@ -0,0 +1,84 @@
+from LocalRanker import LocalRanker
+
+
+def widget(clz="android.widget.TextView", rid="", text="", desc="", parent_text=""):
+    return {
+        "class": clz,
+        "resource-id": rid,
+        "text": text,
+        "content-desc": desc,
+        "parent_text": parent_text,
+        "sibling_text": "",
+    }
+
+
+def click(text, **kwargs):
+    return dict({"action": "click", "id": "", "text": text}, **kwargs)
+
+
+def ranked(tuples):
+    return [(w["text"] or w["content-desc"] or w["parent_text"], s) for w, s in tuples]
+
+
+def test_exact_match_ranks_above_partial_and_unrelated_are_dropped():
+    candidates = [
+        widget(text="Search files"),
+        widget(text="Settings"),
+        widget(text="Search"),
+    ]
+    assert ranked(LocalRanker.rank(click("Search"), candidates)) == [
+        ("Search", 1.0),
+        ("Search files", 0.7071),
+    ]
+
+
+def test_ties_keep_the_candidate_order_and_top_truncates():
+    candidates = [
+        widget(desc="Search"),
+        widget(text="Search"),
+        widget(text="Search files"),
+    ]
+    result = LocalRanker.rank(click("Search"), candidates, top=2)
+    assert ranked(result) == [("Search", 1.0), ("Search", 1.0)]
+    assert [w["content-desc"] for w, _ in result] == ["Search", ""]
+
+
+def test_context_breaks_ties():
+    candidates = [
+        widget(text="Search", parent_text="Photos"),
+        widget(text="Search", parent_text="Files"),
+    ]
+    result = LocalRanker.rank(click("Search", prev_sibling_text="Files"), candidates)
+    assert [(w["parent_text"], s) for w, s in result] == [
+        ("Files", 1.0),
+        ("Photos", 0.8),
+    ]
+
+
+def test_button_labels_only_with_expand_btn_to_text():
+    candidates = [
+        widget(clz="android.widget.ImageButton", parent_text="Log in"),
+        widget(text="Log in"),
+    ]
+    assert ranked(LocalRanker.rank(click("Log in"), candidates)) == [("Log in", 1.0)]
+    expanded = LocalRanker.rank(click("Log in"), candidates, expand_btn_to_text=True)
+    assert [w["class"] for w, _ in expanded] == [
+        "android.widget.ImageButton",
+        "android.widget.TextView",
+    ]
+
+
+def test_precomputed_features_rank_the_same():
+    candidates = [
+        widget(text="Search files"),
+        widget(text="Search"),
+        widget(desc="Search"),
+    ]
+    features = [LocalRanker.widget_features(w) for w in candidates]
+    assert LocalRanker.rank(
+        click("Search"), candidates, features=features
+    ) == LocalRanker.rank(click("Search"), candidates)
+
+
+def test_event_without_tokens_ranks_nothing():
+    assert LocalRanker.rank(click(""), [widget(text="Search")]) == []
@@ -0,0 +1,43 @@
+import time
+
+from RankCache import RankCache
+
+
+def test_reads_do_not_write(tmp_path):
+    cache = RankCache(str(tmp_path / "rankings.sqlite"))
+    cache.put("a", [["sig", 1.0]])
+    changes = cache.conn.total_changes
+    assert cache.get("a") == [("sig", 1.0)]
+    assert cache.get("b") is None
+    assert cache.conn.total_changes == changes
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+    assert cache.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    cache.close()
+
+
+def test_eviction_sees_the_access_times_of_reads():
+    cache = RankCache(max_entries=2)
+    cache.put("old", [])
+    cache.put("new", [])
+    time.sleep(0.01)
+    assert cache.get("old") == []  # now the most recently used
+    cache.put("newest", [])
+    assert "old" in cache and "newest" in cache and "new" not in cache
+
+
+def test_flush_writes_the_access_times():
+    cache = RankCache()
+    cache.put("a", [])
+    (before,) = cache.conn.execute("SELECT accessed FROM rankings").fetchone()
+    time.sleep(0.01)
+    cache.get("a")
+    cache.flush()
+    (after,) = cache.conn.execute("SELECT accessed FROM rankings").fetchone()
+    assert after > before and not cache.accessed
+
+
+def test_expired_entries_are_misses():
+    cache = RankCache(ttl=0)
+    cache.put("a", [])
+    time.sleep(0.01)
+    assert cache.get("a") is None and "a" not in cache
@@ -0,0 +1,56 @@
+import glob
+import os
+
+import pytest
+
+from ScreenSnapshot import ScreenSnapshot
+from WidgetUtil import WidgetUtil
+
+# the soup reference implementation parses the XML dumps with the HTML parser of bs4, as it always has
+pytestmark = pytest.mark.filterwarnings("ignore::bs4.XMLParsedAsHTMLWarning")
+# page_source dumps of ownCloud screens, in the format of Appium's UiAutomator2 driver
+DUMPS = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "dumps", "*.xml")))
+
+
+def read_dump(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("path", DUMPS, ids=os.path.basename)
+def test_retrieve_widgets_matches_soup(path):
+    dump = read_dump(path)
+    expected = WidgetUtil.retrieve_widgets_from_soup("pkg", "act", dump)
+    assert expected
+    assert WidgetUtil.retrieve_widgets("pkg", "act", dump) == expected
+    assert WidgetUtil.retrieve_widgets("pkg", "act", ScreenSnapshot(dump)) == expected
+
+
+def test_dumps_present():
+    assert DUMPS
+
+
+def test_rerank_remote_keeps_one_scale_and_omitted_candidates(monkeypatch):
+    widgets = [{"class": "android.widget.TextView", "text": t} for t in "abcdef"]
+    local = list(zip(widgets, [0.9, 0.8, 0.7, 0.6, 0.5, 0.4]))
+
+    def rank_remote(src_event, candidates):
+        # the service prefers c, then a and d equally, and leaves out b
+        by_text = {w["text"]: w for w in candidates}
+        return [
+            (dict(by_text["c"], sim_score=0.95), 0.95),
+            (dict(by_text["a"], sim_score=0.3), 0.3),
+            (dict(by_text["d"], sim_score=0.3), 0.3),
+        ]
+
+    monkeypatch.setattr(WidgetUtil, "rank_remote", rank_remote)
+    result = WidgetUtil.rerank_remote({}, local, top_k=4)
+    assert [(w["text"], s) for w, s in result] == [
+        ("c", 0.9),
+        ("a", 0.8),
+        ("d", 0.8),
+        ("b", 0.6),
+        ("e", 0.5),
+        ("f", 0.4),
+    ]
+    assert result[0][0] is widgets[2]